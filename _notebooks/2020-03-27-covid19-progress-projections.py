@@ -37,7 +37,7 @@ except ImportError:
 
 covid_data = covid_helpers.CovidData()
 stylers = covid_helpers.PandasStyling
-df_all, debug_dfs = covid_data.table_with_projections(debug_dfs=True)
+df_all, df_alt = covid_data.table_with_projections(debug_dfs=True, debug_day_window=(-119, None))
 df = covid_data.filter_df(df_all)
 df.columns
 # -
@@ -148,8 +148,7 @@ df_show = df_show[cols.keys()].rename(columns=cols)
 # > Note: For stacked plots of all countries see [world plots notebook](/pages/covid-world-progress/)
 
 #hide_input
-df_alt = pd.concat([d.reset_index() for d in debug_dfs], axis=0)
-df_alt_filt = df_alt[(df_alt['day'] > -120) & (df_alt['country'].isin(df.index))]
+df_alt_filt = df_alt[df_alt['country'].isin(df.index)]
 covid_helpers.altair_sir_plot(df_alt_filt, df['Deaths.new.per100k'].idxmax())
 
 # ## Full table with more details
@@ -44,9 +44,7 @@ Markdown(f"*Based on data up to:* ***{covid_data.cur_date}***")
 
 # +
 #hide
-_, debug_dfs = covid_data.table_with_projections(debug_dfs=True)
-
-df_alt = pd.concat([d.reset_index() for d in debug_dfs], axis=0)
+_, df_alt = covid_data.table_with_projections(debug_dfs=True)
 # -
 
 #hide
@@ -42,7 +42,8 @@ stylers = covid_helpers.PandasStyling
 day_diff = 10
 
 cur_data = covid_helpers.CovidData()
-df_cur_all, debug_dfs = cur_data.table_with_projections(projection_days=[30], debug_dfs=True)
+df_cur_all, df_alt_all = cur_data.table_with_projections(
+    projection_days=[30], debug_dfs=True, debug_day_window=(-120, None))
 df_cur = cur_data.filter_df(df_cur_all)
 
 past_data = covid_helpers.CovidData(-day_diff)
@@ -51,7 +52,7 @@ df_past = past_data.filter_df(past_data.table_with_projections(projection_days=[
 
 #hide_input
 from IPython.display import Markdown
-past_date = pd.to_datetime(past_data.dt_cols[-1]).date().isoformat()
+past_date = past_data.dates[-1].date().isoformat()
 Markdown(f"***Based on data up to: {cur_data.cur_date}. \
             Compared to ({day_diff} days before): {past_date}***")
 
@@ -136,7 +137,6 @@ Markdown(f"## &#11093; Bad news: new waves {emoji_flags(new_waves)}")
 style_news_infections(df_data.loc[new_waves])
 
 #hide
-df_alt_all = pd.concat([d.reset_index() for d in debug_dfs], axis=0)
 def infected_plots(countries, title):
     return covid_helpers.altair_multiple_countries_infected(
         df_alt_all, countries=countries, title=title, marker_day=day_diff)
@@ -0,0 +1,37 @@
+"""
+Times backfill_missing (per series) against backfill_missing_matrix on the daily cases
+of the bundled JHU confirmed snapshot, and checks that their results are identical.
+
+Usage (from _notebooks): python benchmark_backfill.py [repeats]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from covid_helpers import COL_REGION, SourceData, backfill_missing, backfill_missing_matrix
+
+
+def main(repeats=3):
+    df = SourceData._load_covid_df('confirmed')
+    cases = df[SourceData.get_dates(df)].groupby(df[COL_REGION]).sum()
+    diffs = cases.diff(axis=1)
+    diffs.iloc[:, 0] = cases.iloc[:, 0]
+
+    def per_series():
+        return np.vstack([backfill_missing(row).to_numpy(dtype=float)
+                          for _, row in diffs.iterrows()])
+
+    def matrix():
+        return backfill_missing_matrix(diffs.to_numpy())
+
+    assert np.array_equal(per_series(), matrix(), equal_nan=True), 'results differ'
+
+    print(f'{diffs.shape[0]} regions x {diffs.shape[1]} days, best of {repeats}:')
+    for name, func in [('backfill_missing', per_series), ('backfill_missing_matrix', matrix)]:
+        best = min(timeit.repeat(func, number=1, repeat=repeats))
+        print(f'  {name}: {best * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
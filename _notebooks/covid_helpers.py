@@ -1,8 +1,18 @@
 import functools
+import hashlib
+import io
+import json
 import os
+import pickle
 import re
-from typing import Tuple, List
-from urllib import request
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent import futures
+from typing import Callable, Dict, Iterable, Tuple, List
+from urllib import request, error
 
 import numpy as np
 import pandas as pd
@@ -22,48 +32,792 @@ pd.set_option('display.width', 10000)
 func_cache = functools.lru_cache(maxsize=None)  # simple memory caching
 
 
+class DiskCache:
+    """
+    Persistent memoization of function results (pickled to files), shared between
+    processes (e.g. notebooks running one after the other). Results are keyed by the
+    function (name and code), by the source of the function's module (so that changes to
+    the code it calls invalidate its results), and by the content of the arguments.
+    Objects (and classes passed as the first argument of classmethods) can define a
+    `__disk_cache_key__()` method to provide their key (e.g. a hash of their source
+    data, and the class level parameters of the calculations).
+
+    Entries older than max_age are ignored and removed, and least recently used entries
+    are removed when the folder grows beyond max_size. Can be disabled by setting
+    `enabled` or the COVID_DISK_CACHE=0 environment variable.
+    """
+    folder = os.path.join(data_folder, 'func_cache')
+    max_age = 24 * 3600  # seconds
+    max_size = 2 ** 30  # bytes
+    enabled = None
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        if cls.enabled is not None:
+            return cls.enabled
+        return os.environ.get('COVID_DISK_CACHE', '').lower() not in ('0', 'false')
+
+    @staticmethod
+    def _hash_arg(arg, hasher):
+        if hasattr(arg, '__disk_cache_key__'):
+            DiskCache._hash_arg(arg.__disk_cache_key__(), hasher)
+        elif isinstance(arg, (pd.DataFrame, pd.Series, pd.Index)):
+            hasher.update(pd.util.hash_pandas_object(arg).to_numpy().tobytes())
+            if isinstance(arg, pd.DataFrame):
+                hasher.update(repr(arg.columns.to_list()).encode())
+        elif isinstance(arg, np.ndarray):
+            hasher.update(f'{arg.dtype}{arg.shape}'.encode())
+            hasher.update(np.ascontiguousarray(arg).tobytes())
+        elif isinstance(arg, (list, tuple)):
+            hasher.update(f'{type(arg).__name__}{len(arg)}'.encode())
+            for a in arg:
+                DiskCache._hash_arg(a, hasher)
+        elif isinstance(arg, dict):
+            DiskCache._hash_arg(sorted(arg.items()), hasher)
+        else:
+            hasher.update(pickle.dumps(arg))
+
+    @staticmethod
+    def _hash_code(code, hasher):
+        hasher.update(code.co_code)
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):  # nested functions
+                DiskCache._hash_code(const, hasher)
+            else:
+                hasher.update(repr(const).encode())
+
+    @staticmethod
+    @func_cache
+    def _module_hash(module_name) -> str:
+        path = getattr(sys.modules.get(module_name), '__file__', None)
+        if path is None or not os.path.exists(path):  # e.g. defined in a notebook
+            return ''
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @classmethod
+    def _path(cls, func, args, kwargs):
+        hasher = hashlib.sha256()
+        cls._hash_code(func.__code__, hasher)
+        hasher.update(cls._module_hash(func.__module__).encode())
+        cls._hash_arg((args, kwargs), hasher)
+        return os.path.join(cls.folder, f'{func.__qualname__}-{hasher.hexdigest()}.pkl')
+
+    @classmethod
+    def memoize(cls, func):
+        """Decorator for persistent memoization of func's results"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not cls.is_enabled():
+                return func(*args, **kwargs)
+
+            path = cls._path(func, args, kwargs)
+            if os.path.exists(path) and time.time() - os.path.getmtime(path) < cls.max_age:
+                try:
+                    with open(path, 'rb') as f:
+                        result = pickle.load(f)
+                    os.utime(path)  # for least recently used eviction
+                    return result
+                except Exception as e:  # e.g. a partially written or incompatible file
+                    warnings.warn(f'Failed reading cached {func.__qualname__}: {e!r}')
+
+            result = func(*args, **kwargs)
+            os.makedirs(cls.folder, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            cls.evict()
+            return result
+
+        return wrapper
+
+    @classmethod
+    def _entries(cls) -> List[os.DirEntry]:
+        if not os.path.exists(cls.folder):
+            return []
+        return [e for e in os.scandir(cls.folder) if e.name.endswith('.pkl')]
+
+    @classmethod
+    def evict(cls):
+        """Removes expired entries, and least recently used entries over max_size"""
+        entries = sorted(cls._entries(), key=lambda e: e.stat().st_mtime, reverse=True)
+        total_size = 0
+        for entry in entries:
+            total_size += entry.stat().st_size
+            if (time.time() - entry.stat().st_mtime > cls.max_age or
+                    total_size > cls.max_size):
+                os.remove(entry.path)
+
+    @classmethod
+    def clear(cls, func=None):
+        """Removes all entries, or only the entries of func"""
+        for entry in cls._entries():
+            if func is None or entry.name.startswith(f'{func.__qualname__}-'):
+                os.remove(entry.path)
+
+
+class Checkpoint:
+    """
+    Persisted per region results and state of a calculation over the days of (regions x
+    days) inputs, so that when new days arrive, the calculation resumes from the saved
+    state and only calculates the new days. Regions whose inputs of the saved days changed
+    (e.g. upstream revised past values) or that are new are calculated from the start.
+
+    Checkpoints are files in `folder` by name, and are ignored if they were saved with other
+    params (e.g. the calculation's parameters and code hash), or for a longer history
+    (e.g. an older days offset). Can be disabled by setting `enabled` or the
+    COVID_CHECKPOINTS=0 environment variable.
+
+    Usage: restore() the saved days' results into the results arrays, calculate the
+    groups(), and save() the results arrays.
+    """
+    folder = os.path.join(data_folder, 'checkpoints')
+    enabled = None
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        if cls.enabled is not None:
+            return cls.enabled
+        return os.environ.get('COVID_CHECKPOINTS', '').lower() not in ('0', 'false')
+
+    @staticmethod
+    def code_hash(*funcs) -> str:
+        """hash of the functions' code and default arguments (e.g. thresholds)"""
+        hasher = hashlib.sha256()
+        for func in funcs:
+            DiskCache._hash_code(func.__code__, hasher)
+            hasher.update(repr((func.__defaults__, func.__kwdefaults__)).encode())
+        return hasher.hexdigest()
+
+    def __init__(self, name: str, params: dict, index: pd.Index, columns: pd.Index,
+                 inputs: Dict[str, np.ndarray]):
+        """
+        :param name: file name of the checkpoint
+        :param params: parameters the results depend on other than the inputs
+        :param index: regions of the inputs
+        :param columns: days of the inputs
+        :param inputs: (regions x days) arrays the results depend on
+        """
+        self.path = os.path.join(self.folder, f'{name}.pkl')
+        self.params = params
+        self.index = index
+        self.columns = list(columns)
+        self.inputs = inputs
+        self._superseded = False  # a longer history was saved
+        self.saved = self._load()
+        self.n_days = len(self.saved['columns']) if self.saved else 0
+        self.rows = self._resumable_rows()
+        self.resumed = self.rows >= 0
+
+    def _load(self):
+        if not self.is_enabled() or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+        except Exception as e:  # e.g. a partially written or incompatible file
+            warnings.warn(f'Failed reading checkpoint {self.path}: {e!r}')
+            return None
+        if saved['params'] != self.params:
+            return None
+        if saved['columns'] != self.columns[:len(saved['columns'])]:
+            self._superseded = saved['columns'][:len(self.columns)] == self.columns
+            return None
+        return saved
+
+    def _resumable_rows(self) -> np.ndarray:
+        """positions of the regions in the saved checkpoint, -1 if not resumable"""
+        if self.saved is None or not len(self.saved['index']):
+            return np.full(len(self.index), -1)
+        rows = self.saved['index'].get_indexer(self.index)
+        for name, values in self.inputs.items():
+            saved = self.saved['inputs'][name][rows]
+            current = values[:, :self.n_days]
+            same = (saved == current) | (pd.isna(saved) & pd.isna(current))
+            rows[~same.all(axis=1)] = -1
+        return rows
+
+    def restore(self, **results):
+        """copies the saved days of the resumed regions into the results arrays"""
+        if not self.resumed.any():
+            return
+        for name, arr in results.items():
+            days = (slice(0, self.n_days),) * (arr.ndim - 1)
+            arr[(self.resumed,) + days] = self.saved['results'][name][self.rows[self.resumed]]
+
+    def groups(self):
+        """
+        :return: (regions mask, first day to calculate) of the regions calculated from the
+            start, and of the resumed regions, if they have days to calculate
+        """
+        for rows, start in [(~self.resumed, 0), (self.resumed, self.n_days)]:
+            if rows.any() and start < len(self.columns):
+                yield rows, start
+
+    def save(self, **results):
+        """saves the results arrays (regions first) of the inputs days"""
+        if not self.is_enabled() or self._superseded:
+            return
+        checkpoint = {'params': self.params, 'index': self.index, 'columns': self.columns,
+                      'inputs': self.inputs, 'results': results}
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class _LoadedAttribute:
+    """
+    Class level attribute that is resolved from the owner's `load()` on first access
+    (from the class or from an instance), so that importing this module doesn't
+    trigger any downloads.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return owner.load()[self.name]
+
+
+class HttpCache:
+    """
+    Fetches URLs through a local cache keyed by URL. Cached copies are revalidated with
+    conditional requests (ETag / Last-Modified) and reused when the server responds with
+    304 or when the downloaded content has the same hash as the cached copy.
+
+    Modes (class attributes, or environment variables if not set):
+        - offline (COVID_DATA_OFFLINE=1): only cached copies are used, nothing is fetched
+        - mirror (COVID_DATA_MIRROR=<dir or url>): files are fetched from a local
+            directory or a local HTTP stand-in by their file name instead of from
+            the original URL
+    """
+    cache_folder = os.path.join(data_folder, 'http_cache')
+    timeout = 60  # seconds
+    offline = None
+    mirror = None
+
+    @classmethod
+    def is_offline(cls) -> bool:
+        if cls.offline is not None:
+            return cls.offline
+        return os.environ.get('COVID_DATA_OFFLINE', '').lower() not in ('', '0', 'false')
+
+    @classmethod
+    def mirror_location(cls):
+        return cls.mirror or os.environ.get('COVID_DATA_MIRROR') or None
+
+    @classmethod
+    def _cache_path(cls, url):
+        return os.path.join(cls.cache_folder, hashlib.sha1(url.encode()).hexdigest())
+
+    @classmethod
+    def meta(cls, url) -> dict:
+        """Metadata of the cached copy (validators, content hash), empty if not cached"""
+        path = cls._cache_path(url) + '.json'
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    @classmethod
+    def is_cached(cls, url) -> bool:
+        return os.path.exists(cls._cache_path(url)) and bool(cls.meta(url))
+
+    @classmethod
+    def _write_meta(cls, url, meta):
+        path = cls._cache_path(url) + '.json'
+        with tempfile.NamedTemporaryFile('w', dir=cls.cache_folder, suffix='.tmp',
+                                         delete=False) as f:
+            json.dump(meta, f)
+        os.replace(f.name, path)
+
+    @classmethod
+    def fetch_path(cls, url) -> str:
+        """
+        :param url: URL to fetch
+        :return: path of a local file with the content of the URL, the cached copy
+            is only re-downloaded if it's not up to date
+        """
+        mirror = cls.mirror_location()
+        file_name = url.rstrip('/').split('/')[-1]
+        cached_path = cls._cache_path(url)
+
+        if cls.is_offline():
+            if not cls.is_cached(url):
+                raise FileNotFoundError(f'Offline mode and no cached copy of {url}')
+            return cached_path
+
+        if mirror and not mirror.startswith(('http://', 'https://')):
+            return os.path.join(mirror, file_name)
+
+        fetch_url = f'{mirror.rstrip("/")}/{file_name}' if mirror else url
+        meta = cls.meta(url) if cls.is_cached(url) else {}
+        headers = {}
+        if meta.get('source') == fetch_url:  # validators are only valid for the same source
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        os.makedirs(cls.cache_folder, exist_ok=True)
+        content_hash = hashlib.sha256()
+        # stream to a temporary file to not hold large files in memory, and to not leave
+        # partial files on failures. The file is unique per fetch, so that a concurrent
+        # fetch of the same URL (e.g. by a loader thread that outlived its timeout)
+        # doesn't write into the same file
+        tmp_file = tempfile.NamedTemporaryFile(
+            dir=cls.cache_folder, prefix=os.path.basename(cached_path) + '.',
+            suffix='.tmp', delete=False)
+        try:
+            with request.urlopen(request.Request(fetch_url, headers=headers),
+                                 timeout=cls.timeout) as response, tmp_file as f:
+                for block in iter(functools.partial(response.read, 1 << 20), b''):
+                    content_hash.update(block)
+                    f.write(block)
+                response_headers = response.headers
+        except error.HTTPError as e:
+            os.remove(tmp_file.name)
+            if e.code == 304:  # not modified
+                return cached_path
+            raise
+        except BaseException:
+            os.remove(tmp_file.name)
+            raise
+
+        new_meta = {'url': url,
+                    'source': fetch_url,
+                    'etag': response_headers.get('ETag'),
+                    'last_modified': response_headers.get('Last-Modified'),
+                    'sha256': content_hash.hexdigest(),
+                    'fetched_at': time.time()}
+        if meta.get('sha256') == new_meta['sha256']:
+            os.remove(tmp_file.name)  # unchanged content, only refresh the validators
+        else:
+            os.replace(tmp_file.name, cached_path)
+        cls._write_meta(url, new_meta)
+        return cached_path
+
+    @classmethod
+    def fetch(cls, url) -> bytes:
+        """
+        :param url: URL to fetch
+        :return: content (bytes) of the URL, from the cache if it is still up to date
+        """
+        with open(cls.fetch_path(url), 'rb') as f:
+            return f.read()
+
+    @classmethod
+    def read_csv(cls, url, **kwargs) -> pd.DataFrame:
+        return pd.read_csv(cls.fetch_path(url), **kwargs)
+
+
+def load_concurrently(loaders: Dict[str, Callable],
+                      timeouts: Dict[str, float] = None,
+                      default_timeout: float = 300,
+                      required: Iterable[str] = None) -> dict:
+    """
+    Runs source loading functions in parallel threads, so that the total latency is
+    that of the slowest source rather than the sum of all of them.
+
+    :param loaders: dict of source name to a function (without arguments) loading it
+    :param timeouts: optional per source timeouts in seconds
+    :param default_timeout: timeout for sources not in timeouts
+    :param required: names of sources whose failure is raised, failures of other
+        sources are only warned about and their result is None. If None, all are required
+    :return: dict of source name to loaded result
+    """
+    timeouts = timeouts or {}
+    required = set(loaders if required is None else required)
+    start = time.time()
+    results = {}
+    executor = futures.ThreadPoolExecutor(max_workers=len(loaders))
+    try:
+        submitted = {name: executor.submit(func) for name, func in loaders.items()}
+        for name, future in submitted.items():
+            remaining = timeouts.get(name, default_timeout) - (time.time() - start)
+            try:
+                results[name] = future.result(timeout=max(remaining, 0))
+            except Exception as e:
+                if name in required:
+                    raise
+                warnings.warn(f'Failed loading {name}: {e!r}')
+                results[name] = None
+    finally:
+        # don't wait for timed out sources
+        executor.shutdown(wait=False)
+    return results
+
+
+def _run_row_shard(func, paths, axis, start, stop, kwargs):
+    """runs func on a slice of memory mapped arrays (in a worker process of RowShards)"""
+    arrays = []
+    for path in paths:
+        arr = np.load(path, mmap_mode='r').view(np.ndarray)
+        index = [slice(None)] * arr.ndim
+        index[axis] = slice(start, stop)
+        arrays.append(arr[tuple(index)])
+    return func(*arrays, **kwargs)
+
+
+class RowShards:
+    """
+    Runs functions whose rows (regions) are computed independently of each other on
+    contiguous shards of the rows in a process pool, and concatenates the shards'
+    results, so results are identical to running the function on all the rows at once.
+
+    The input arrays are saved once to memory mapped files (in shared memory where
+    available) which the workers map, instead of being pickled to each worker.
+
+    Number of workers is the `workers` class attribute, or the COVID_WORKERS environment
+    variable if not set, 1 (no pool) by default. Inputs with less than min_shard_rows
+    rows per worker use less workers.
+    """
+    workers = None
+    min_shard_rows = 100
+
+    @classmethod
+    def n_workers(cls) -> int:
+        if cls.workers is not None:
+            return max(int(cls.workers), 1)
+        return max(int(os.environ.get('COVID_WORKERS') or 1), 1)
+
+    @classmethod
+    def map(cls, func: Callable, arrays: List[np.ndarray], axis=0, **kwargs):
+        """
+        :param func: picklable function (e.g. module level) of the arrays and kwargs,
+            returning an array or a tuple of arrays with the rows on the same axis
+        :param arrays: input arrays, all with the same number of rows on axis
+        :param axis: the rows' axis of the inputs and of the results
+        :param kwargs: other (non row) arguments of func
+        :return: func's result
+        """
+        n_rows = arrays[0].shape[axis]
+        n_shards = min(cls.n_workers(), n_rows // cls.min_shard_rows)
+        if n_shards <= 1:
+            return func(*arrays, **kwargs)
+
+        bounds = np.linspace(0, n_rows, n_shards + 1).astype(int)
+        shm_folder = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.TemporaryDirectory(dir=shm_folder) as folder:
+            paths = []
+            for i, arr in enumerate(arrays):
+                paths.append(os.path.join(folder, f'{i}.npy'))
+                np.save(paths[-1], np.asarray(arr))
+            with futures.ProcessPoolExecutor(max_workers=n_shards) as executor:
+                shards = list(executor.map(
+                    _run_row_shard, *zip(*[(func, paths, axis, start, stop, kwargs)
+                                           for start, stop in zip(bounds[:-1], bounds[1:])])))
+
+        if isinstance(shards[0], tuple):
+            return tuple(np.concatenate(parts, axis=axis) for parts in zip(*shards))
+        return np.concatenate(shards, axis=axis)
+
+
+class Countries:
+    """
+    Canonical country dimension. Every source maps its country names once into the
+    canonical (JHU based) names via `canonical()`. An instance holds the canonical
+    index of the countries in the data, and aligns other sources' data to it by
+    integer codes, so that tables can be joined positionally.
+    """
+    # source specific names (OWID, UN population, emoji flags, hospital beds, map
+    # shapes) to canonical names. JHU's renames are in mapping_countries.csv
+    aliases = {
+        'United States': 'US',
+        'United States of America': 'US',
+        'Taiwan': 'Taiwan*',
+        'China, Taiwan Province of China': 'Taiwan*',
+        'Democratic Republic of Congo': 'Congo (Kinshasa)',
+        'Democratic Republic of the Congo': 'Congo (Kinshasa)',
+        'Congo': 'Congo (Brazzaville)',
+        'Myanmar': 'Burma',
+        'Palestine': 'West Bank and Gaza',
+        'State of Palestine': 'West Bank and Gaza',
+        'Palestinian Territory': 'West Bank and Gaza',
+        'Timor': 'Timor-Leste',
+        'United Republic of Tanzania': 'Tanzania',
+        'Iran (Islamic Republic of)': 'Iran',
+        'Republic of Korea': 'South Korea',
+        'Bolivia (Plurinational State of)': 'Bolivia',
+        'Venezuela (Bolivarian Republic of)': 'Venezuela',
+        'Republic of Moldova': 'Moldova',
+        'Russian Federation': 'Russia',
+        'Côte d\'Ivoire': 'Cote d\'Ivoire',
+        'Côte D\'Ivoire': 'Cote d\'Ivoire',
+        'Syrian Arab Republic': 'Syria',
+        'Viet Nam': 'Vietnam',
+        'Brunei Darussalam': 'Brunei',
+        'Lao People\'s Democratic Republic': 'Laos',
+        'Macedonia': 'North Macedonia',
+        'Cape Verde': 'Cabo Verde',
+        'Saint Vincent and The Grenadines': 'Saint Vincent and the Grenadines',
+        'Czech Republic': 'Czechia',
+        'United Kingdom (more)': 'United Kingdom',
+        'Bosnia and Herz.': 'Bosnia and Herzegovina',
+    }
+
+    def __init__(self, names: Iterable[str]):
+        self.index = pd.Index(sorted(set(self.canonical(pd.Series(list(names))))),
+                              name=COL_REGION)
+
+    def __len__(self):
+        return len(self.index)
+
+    @classmethod
+    @func_cache
+    def _mappings_df(cls) -> pd.DataFrame:
+        return pd.read_csv(os.path.join(data_folder, 'mapping_countries.csv'))
+
+    @classmethod
+    @func_cache
+    def all_aliases(cls) -> dict:
+        df_mappings = cls._mappings_df().dropna(subset=['Name'])
+        return {**dict(df_mappings.set_index('Country')['Name']), **cls.aliases}
+
+    @classmethod
+    def canonical(cls, names: pd.Series) -> pd.Series:
+        return names.map(cls.all_aliases()).fillna(names)
+
+    def codes(self, names) -> np.ndarray:
+        """
+        :param names: canonical country names
+        :return: integer codes of the names in this index (-1 for unknown names)
+        """
+        return self.index.get_indexer(names)
+
+    def align(self, data, names=None):
+        """
+        Maps a source's data into this index. Rows of unknown countries are dropped,
+        countries missing in the data are NaN, and for duplicates the first row is used.
+
+        :param data: series or dataframe
+        :param names: canonical country names of data's rows, data's index if None
+        :return: data with this index (in this index's order)
+        """
+        codes = self.codes(data.index if names is None else names)
+        rows = np.full(len(self), -1)
+        valid = np.flatnonzero(codes >= 0)[::-1]  # reversed so that first rows are kept
+        rows[codes[valid]] = valid
+        # positional reindexing (on a range index), -1 rows become NaN
+        aligned = data.reset_index(drop=True).reindex(rows)
+        aligned.index = self.index
+        return aligned
+
+    def take(self, aligned, codes):
+        """
+        Positional lookup of rows of aligned data (in this index's order) by codes.
+
+        :param aligned: series or dataframe aligned to this index (e.g. by `align()`)
+        :param codes: integer codes (-1 rows become NaN)
+        :return: the rows, with a range index
+        """
+        return aligned.reset_index(drop=True).reindex(codes).reset_index(drop=True)
+
+    @property
+    def continent(self) -> pd.Series:
+        df_mappings = self._mappings_df()
+        return self.align(df_mappings.set_index('Name')['Continent'])
+
+    @property
+    def iso2(self) -> pd.Series:
+        df_flags = EmojiFlags.load()
+        return self.align(df_flags.set_index(COL_REGION)['ISO'])
+
+
 class SourceData:
-    df_mappings = pd.read_csv(os.path.join(data_folder, 'mapping_countries.csv'))
 
-    mappings = {'replace.country': dict(df_mappings.dropna(subset=['Name'])
-                                        .set_index('Country')['Name']),
-                'map.continent': dict(df_mappings.set_index('Name')['Continent'])
-                }
+    meta_cols = ['Province/State', COL_REGION, 'Lat', 'Long']
+
+    @classmethod
+    def _cache_path(cls, name):
+        return os.path.join(data_folder, f'covid_jhu/{name}')
+
+    # incremental ingestion: only new date columns and revised rows are parsed, unless
+    # more than this ratio of rows was revised, in which case everything is re-parsed
+    incremental_ingest = True
+    max_revised_ratio = 0.1
 
     @classmethod
-    def _cache_csv_path(cls, name):
-        return os.path.join(data_folder, f'covid_jhu/{name}_transposed.csv')
+    def _save_covid_df(cls, df, name, **extra_index):
+        dates = cls.get_dates(df)
+        cls._save_covid_matrix(name, df[dates].to_numpy(), df[cls.meta_cols], dates,
+                               **extra_index)
+
+    @classmethod
+    def _save_covid_matrix(cls, name, values, meta_df, dates, **extra_index):
+        """
+        Saves the values as a compressed typed matrix (regions x dates, .npz) and the
+        region metadata and dates as a json sidecar. Counts are saved as daily int32
+        counts, which compress much better than the cumulative ones.
+        """
+        arrays = {'values': values}
+        if np.isfinite(values).all() and np.abs(values).max(initial=0) < np.iinfo(np.int32).max:
+            daily = np.diff(values.astype(np.int64), axis=1, prepend=0)
+            if np.abs(daily).max(initial=0) < np.iinfo(np.int32).max:
+                arrays = {'daily': daily.astype(np.int32)}
+        meta_df = meta_df.astype(object).where(meta_df.notna(), None)
+        index = {'dates': list(dates),
+                 'rows': {col: meta_df[col].to_list() for col in cls.meta_cols},
+                 **extra_index}
+
+        path = cls._cache_path(name)
+        np.savez_compressed(path + '.npz', **arrays)
+        with open(path + '.json', 'w') as f:
+            json.dump(index, f)
 
     @classmethod
-    def _save_covid_df(cls, df, name):
-        df.T.to_csv(cls._cache_csv_path(name))
+    def _load_index(cls, name) -> dict:
+        path = cls._cache_path(name) + '.json'
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    @classmethod
+    def load_covid_matrix(cls, name) -> Tuple[np.ndarray, pd.DataFrame, pd.Index]:
+        """
+        :param name: time series name
+        :return: values matrix (regions x dates), region metadata dataframe, dates
+        """
+        with np.load(cls._cache_path(name) + '.npz') as arrays:
+            if 'daily' in arrays:
+                values = np.cumsum(arrays['daily'], axis=1, dtype=np.int64).astype(np.int32)
+            else:
+                values = arrays['values']
+        index = cls._load_index(name)
+        meta_df = pd.DataFrame(index['rows'], columns=cls.meta_cols)
+        meta_df[['Lat', 'Long']] = meta_df[['Lat', 'Long']].astype(float)
+        return values, meta_df, pd.Index(index['dates'])
 
     @classmethod
     def _load_covid_df(cls, name):
-        df = pd.read_csv(cls._cache_csv_path(name), index_col=0).T
-        df[df.columns[2:]] = df[df.columns[2:]].apply(pd.to_numeric, errors='coerce')
-        return df
+        values, meta_df, dates = cls.load_covid_matrix(name)
+        return pd.concat([meta_df, pd.DataFrame(values, columns=dates)], axis=1)
 
     @classmethod
-    def _download_covid_df(cls, name):
-        url = ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/'
-               f'csse_covid_19_time_series/time_series_covid19_{name}_global.csv')
-        df = pd.read_csv(url)
+    def _covid_df_url(cls, name):
+        return ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/'
+                f'csse_covid_19_time_series/time_series_covid19_{name}_global.csv')
+
+    lookup_url = ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/'
+                  'csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv')
+
+    @staticmethod
+    def _line_hash(line):
+        return hashlib.md5(line.encode()).hexdigest()
+
+    @classmethod
+    def _ingest_covid_df(cls, name, content: bytes) -> pd.DataFrame:
+        """
+        Parses downloaded csv content and updates the saved matrix. If the content
+        only appends date columns to (or revises a few rows of) the previously
+        ingested content, only the delta is parsed and appended to the saved matrix.
+        """
+        content_hash = hashlib.sha256(content).hexdigest()
+        index = cls._load_index(name)
+        if index.get('source_sha256') == content_hash:
+            return cls._load_covid_df(name)  # already ingested
+
+        lines = [l for l in content.decode().splitlines() if l]
+        header, rows = lines[0], lines[1:]
+        row_hashes = [cls._line_hash(l) for l in rows]
+
+        df = cls._ingest_delta(name, index, header, rows) if cls.incremental_ingest else None
+        if df is None:  # full rebuild
+            df = pd.read_csv(io.BytesIO(content))
+            if len(df) != len(rows):  # e.g. multiline quoted fields, can't map lines to rows
+                row_hashes = None
+
+        cls._save_covid_df(df, name, source_sha256=content_hash, row_hashes=row_hashes)
         return df
 
+    @classmethod
+    def _ingest_delta(cls, name, index, header, rows):
+        """
+        :return: updated dataframe, or None if incremental update isn't possible
+        """
+        old_hashes = index.get('row_hashes')
+        if not old_hashes or len(old_hashes) != len(rows):
+            return None  # nothing ingested before, or regions were added / removed
+
+        old_dates = index['dates']
+        dates = header.split(',')[len(cls.meta_cols):]
+        n_new = len(dates) - len(old_dates)
+        if header.split(',')[:len(cls.meta_cols)] != cls.meta_cols or dates[:len(old_dates)] != old_dates:
+            return None  # not append-only
+
+        # values are never quoted, so splitting from the right separates new values
+        splits = [row.rsplit(',', n_new) if n_new else [row] for row in rows]
+        revised = np.array([cls._line_hash(split[0]) != old_hash
+                            for split, old_hash in zip(splits, old_hashes)])
+        if revised.mean() > cls.max_revised_ratio:
+            return None
+
+        values, meta_df, _ = cls.load_covid_matrix(name)
+        if n_new:  # otherwise only revisions (same dates)
+            new_values = pd.read_csv(io.StringIO('\n'.join(','.join(split[1:]) for split in splits)),
+                                     header=None, names=dates[len(old_dates):]).to_numpy()
+            values = np.concatenate([values, new_values], axis=1)
+
+        if revised.any():
+            df_revised = pd.read_csv(io.StringIO('\n'.join(
+                [header] + [row for row, rev in zip(rows, revised) if rev])))
+            values = values.astype(np.result_type(values, df_revised[dates].to_numpy()))
+            values[revised] = df_revised[dates].to_numpy()
+            meta_df.loc[revised, cls.meta_cols] = df_revised[cls.meta_cols].to_numpy()
+
+        return pd.concat([meta_df, pd.DataFrame(values, columns=dates)], axis=1)
+
     @classmethod
     def get_covid_dataframe(cls, name):
-        df = cls._download_covid_df(name)
-        # df = cls._load_covid_df(name)  # use in case of github outage / data errors
-        cls._save_covid_df(df, name)
+        url = cls._covid_df_url(name)
+        if HttpCache.is_offline() and not HttpCache.is_cached(url):
+            # nothing downloaded yet, use the saved snapshot (e.g. in case of github outage)
+            df = cls._load_covid_df(name)
+        else:
+            df = cls._ingest_covid_df(name, HttpCache.fetch(url))
 
         # rename countries
-        df[COL_REGION] = df[COL_REGION].replace(cls.mappings['replace.country'])
+        df[COL_REGION] = Countries.canonical(df[COL_REGION])
         return df
 
     @staticmethod
     def get_dates(df):
-        return df.columns[~df.columns.isin(['Province/State', COL_REGION, 'Lat', 'Long'])]
+        return df.columns[~df.columns.isin(['Admin2', 'Province/State', COL_REGION, 'Lat', 'Long'])]
+
+    @classmethod
+    def read_us_counties(cls, name, folder) -> pd.DataFrame:
+        """
+        Reads a local copy of JHU's US counties time series (time_series_covid19_{name}_US.csv)
+        with the global time series' column names, and the county in an Admin2 column.
+
+        :param name: 'confirmed' or 'deaths'
+        :param folder: folder of the csv files
+        :return: dataframe of Admin2, meta_cols, Population (deaths only) and dates columns
+        """
+        df = pd.read_csv(os.path.join(folder, f'time_series_covid19_{name}_US.csv'))
+        df = df.rename(columns={'Province_State': 'Province/State',
+                                'Country_Region': COL_REGION,
+                                'Long_': 'Long'})
+        df[COL_REGION] = Countries.canonical(df[COL_REGION])
+        extra_cols = ['Admin2'] + cls.meta_cols + (['Population'] if 'Population' in df else [])
+        dates = df.columns[df.columns.str.fullmatch(r'\d+/\d+/\d+')]
+        return df[extra_cols + list(dates)]
+
+    @classmethod
+    def regions_lookup(cls) -> pd.DataFrame:
+        """
+        JHU's regions lookup table (countries, provinces / states and US counties) with
+        the global time series' column names, and the county in an Admin2 column.
+        """
+        df = HttpCache.read_csv(cls.lookup_url)
+        df = df.rename(columns={'Province_State': 'Province/State',
+                                'Country_Region': COL_REGION,
+                                'Long_': 'Long'})
+        df[COL_REGION] = Countries.canonical(df[COL_REGION])
+        return df
 
 
 class OWID:
@@ -82,21 +836,68 @@ class OWID:
     @classmethod
     @func_cache
     def latest_snapshot(cls):
-        df_raw = pd.read_csv(cls.url_latest)
+        if HttpCache.is_offline() and not HttpCache.is_cached(cls.url_latest):
+            # nothing downloaded yet, the OWID columns are only missing values
+            warnings.warn('Offline mode and no cached copy of OWID data, its columns are empty')
+            columns = [cls.icu_per_mil_col, cls.vaccinated_percent_col,
+                       cls.fully_vaccinated_percent_col, cls.vaccinations_percent_col]
+            return pd.DataFrame(columns=columns, dtype=float,
+                                index=pd.Index([], name=COL_REGION))
+
+        df_raw = HttpCache.read_csv(cls.url_latest)
         df = (df_raw
               .rename(columns={'location': COL_REGION})
               .dropna(subset=[COL_REGION]))
-        df[COL_REGION] = df[COL_REGION].replace({
-            'United States': 'US',
-            'Taiwan': 'Taiwan*',
-            'Democratic Republic of Congo': 'Congo (Kinshasa)',
-            'Congo': 'Congo (Brazzaville)',
-            'Myanmar': 'Burma',
-            'Palestine': 'West Bank and Gaza',
-            'Timor': 'Timor-Leste',
-        })
+        df[COL_REGION] = Countries.canonical(df[COL_REGION])
         return df.set_index(COL_REGION)
 
+    @classmethod
+    def timeseries(cls, columns: List[str], align_to: pd.DataFrame = None,
+                   chunksize=100_000) -> dict:
+        """
+        Streams the full (large) OWID file in chunks, reading only the requested columns,
+        so that memory is bounded by the size of the projected data.
+
+        :param columns: OWID columns to read, e.g. [OWID.icu_per_mil_col]
+        :param align_to: optional country x date dataframe (e.g. CovidData.dft_deaths) to
+            align the results to (same index and date columns)
+        :param chunksize: number of csv rows parsed at a time
+        :return: dict of column name to country x date (JHU date strings) float32 dataframe
+        """
+        chunks = HttpCache.read_csv(cls.url_full,
+                                    usecols=['location', 'date'] + columns,
+                                    dtype={'location': 'category', 'date': 'category',
+                                           **{col: np.float32 for col in columns}},
+                                    chunksize=chunksize)
+        locations, dates, values = [], [], []
+        for chunk in chunks:
+            chunk = chunk.dropna(subset=columns, how='all')
+            # keep only compact data: categoricals and float32 values
+            locations.append(chunk['location'])
+            dates.append(chunk['date'])
+            values.append(chunk[columns].to_numpy())
+
+        locations = pd.api.types.union_categoricals(locations, sort_categories=True)
+        dates = pd.api.types.union_categoricals(dates, sort_categories=True)
+        values = np.concatenate(values)
+        location_codes, location_names = locations.codes, locations.categories
+        date_codes, date_values = dates.codes, dates.categories
+
+        countries = pd.Index(Countries.canonical(pd.Series(location_names)))
+        date_cols = pd.to_datetime(date_values).map(
+            lambda d: f'{d.month}/{d.day}/{d.year % 100:02d}')  # JHU date format
+
+        dfs = {}
+        for i, col in enumerate(columns):
+            matrix = np.full((len(countries), len(date_cols)), np.nan, dtype=np.float32)
+            matrix[location_codes, date_codes] = values[:, i]
+            df = pd.DataFrame(matrix, index=countries, columns=date_cols)
+            df.index.name = COL_REGION
+            if align_to is not None:
+                df = df.reindex(index=align_to.index, columns=align_to.columns)
+            dfs[col] = df
+        return dfs
+
 
 class AgeAdjustedData:
     # https://population.un.org/wpp/Download/Standard/Population/
@@ -156,8 +957,23 @@ class AgeAdjustedData:
     intl_ifrs *= 0.01  # convert from percent to ratio
 
     @classmethod
-    def load(cls):
-        df_raw = pd.read_csv(cls.csv_path)
+    def __disk_cache_key__(cls):
+        with open(cls.csv_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @classmethod
+    @func_cache
+    @DiskCache.memoize
+    def age_distribution(cls) -> Tuple[pd.DataFrame, pd.Series]:
+        """
+        Parses the UN population by age table (once per process, and persisted
+        by DiskCache between processes).
+
+        :return: per country population ratios by age group, total population
+        """
+        # numbers are formatted with space thousands separators, e.g. "  1 234"
+        df_raw = pd.read_csv(cls.csv_path, thousands=' ', skipinitialspace=True,
+                             na_values=['...'])
 
         df_filt = df_raw[df_raw['Type'].isin(['Subregion', 'Country/Area'])]
 
@@ -167,42 +983,33 @@ class AgeAdjustedData:
                    .rename(columns={'Region, subregion, country or area *': COL_REGION}))
 
         # adjust country names
-        df_filt[COL_REGION] = df_filt[COL_REGION].map({
-            'United States of America': 'US',
-            'China, Taiwan Province of China': 'Taiwan*',
-            'United Republic of Tanzania': 'Tanzania',
-            'Iran (Islamic Republic of)': 'Iran',
-            'Republic of Korea': 'South Korea',
-            'Bolivia (Plurinational State of)': 'Bolivia',
-            'Venezuela (Bolivarian Republic of)': 'Venezuela',
-            'Republic of Moldova': 'Moldova',
-            'Russian Federation': 'Russia',
-            'State of Palestine': 'West Bank and Gaza',
-            'Côte d\'Ivoire': 'Cote d\'Ivoire',
-            'Democratic Republic of the Congo': 'Congo (Kinshasa)',
-            'Congo': 'Congo (Brazzaville)',
-            'Syrian Arab Republic': 'Syria',
-            'Myanmar': 'Burma',
-            'Viet Nam': 'Vietnam',
-            'Brunei Darussalam': 'Brunei',
-            'Lao People\'s Democratic Republic': 'Laos'
-        }).fillna(df_filt[COL_REGION])
+        df_filt[COL_REGION] = Countries.canonical(df_filt[COL_REGION])
 
         df_num = df_filt.set_index(COL_REGION)
-
-        # convert to numbers
-        df_num = df_num.apply(lambda s:
-                              pd.Series(s)
-                              .str.replace(' ', '')
-                              .apply(pd.to_numeric, errors='coerce'))
+        # columns were parsed as floats due to missing values ("...") in other rows
+        complete_cols = df_num.columns[df_num.notna().all()]
+        df_num[complete_cols] = df_num[complete_cols].astype(np.int64)
 
         population_s = df_num.sum(1) * 1000
 
         # convert to ratios
         df_pct = (df_num.T / df_num.sum(1)).T
 
+        return df_pct, population_s
+
+    @classmethod
+    @DiskCache.memoize
+    def load(cls, ifrs: pd.Series = None):
+        """
+        :param ifrs: optional IFRs (ratios) by age group (AgeAdjustedData.Cols),
+            defaults to intl_ifrs
+        :return: age adjusted IFR, population, and age adjusted ICU need ratio series
+        """
+        ifrs = cls.intl_ifrs if ifrs is None else ifrs
+        df_pct, population_s = cls.age_distribution()
+
         # calculate IFR
-        ifr_s = pd.Series(np.dot(df_pct, cls.intl_ifrs), index=df_pct.index)
+        ifr_s = pd.Series(np.dot(df_pct, ifrs[df_pct.columns]), index=df_pct.index)
 
         ## icu need estimation
         ## https://www.imperial.ac.uk/media/imperial-college/medicine/sph/ide/gida-fellowships/Imperial-College-COVID19-NPI-modelling-16-03-2020.pdf
@@ -218,39 +1025,105 @@ class ScrapedTableBase:
     page = 'https://page.com/table'
     file_name = 'file.csv'
 
+    # regex matched against the text of the page's tables to find the target
+    # table (first table if None), and attributes the table element must have
+    table_match = None
+    table_attrs = {}
+
+    # saved tables scraped more than ttl ago are refreshed, in a background thread if
+    # refresh_in_background (the saved table is used meanwhile). By default in the
+    # background unless running in CI (the CI environment variable is set), where
+    # the refreshed table isn't kept after the run, so the run should use it
+    ttl = 30 * 24 * 3600  # seconds
+    refresh_in_background = None
+    _refresh_threads = {}
+
     @classmethod
     def csv_path(cls):
         return os.path.join(data_folder, cls.file_name)
 
+    @classmethod
+    def _scrape_info_path(cls):
+        return os.path.splitext(cls.csv_path())[0] + '.json'
+
+    @classmethod
+    def scraped_at(cls):
+        """
+        :return: time the saved table was scraped (seconds since epoch), from its json
+            sidecar (file modification times aren't kept by git), None if unknown
+        """
+        if not os.path.exists(cls._scrape_info_path()):
+            return None
+        with open(cls._scrape_info_path()) as f:
+            return json.load(f).get('scraped_at')
+
+    @classmethod
+    def _background_refresh(cls) -> bool:
+        if cls.refresh_in_background is not None:
+            return cls.refresh_in_background
+        return os.environ.get('CI', '').lower() in ('', '0', 'false')
+
     @classmethod
     def scrape(cls):
         # !pip install beautifulsoup4
         # !pip install lxml
         import bs4
 
-        # read html
-        source = request.urlopen(cls.page).read()
-        soup = bs4.BeautifulSoup(source, 'lxml')
+        # read html, parsing only the table elements
+        source = HttpCache.fetch(cls.page)
+        soup = bs4.BeautifulSoup(source, 'lxml',
+                                 parse_only=bs4.SoupStrainer('table', attrs=cls.table_attrs))
+
+        # get pandas df of only the target table
+        for table in soup.find_all('table'):
+            if cls.table_match is None or re.search(cls.table_match, table.get_text()):
+                return pd.read_html(str(table))[0]
+        raise ValueError(f'No table matching {cls.table_match} found in {cls.page}')
+
+    @classmethod
+    def is_stale(cls):
+        scraped_at = cls.scraped_at()
+        return scraped_at is None or time.time() - scraped_at > cls.ttl
 
-        # get pandas df
-        table = soup.find_all('table')
-        return pd.read_html(str(table))[0]
+    @classmethod
+    def refresh(cls):
+        """Downloads the table again, keeping the saved table on failures"""
+        try:
+            cls.download()
+        except Exception as e:
+            warnings.warn(f'Failed refreshing {cls.__name__}: {e!r}')
 
     @classmethod
     def load(cls):
         if not os.path.exists(cls.csv_path()):
             cls.download()
+        elif cls.is_stale() and not HttpCache.is_offline():
+            if not cls._background_refresh():
+                cls.refresh()
+            elif not (cls in cls._refresh_threads and cls._refresh_threads[cls].is_alive()):
+                cls._refresh_threads[cls] = threading.Thread(target=cls.refresh)
+                cls._refresh_threads[cls].start()
         return pd.read_csv(cls.csv_path())
 
+    @classmethod
+    def save(cls, df):
+        # write to a temporary file and rename to not expose partially written tables
+        df.to_csv(cls.csv_path() + '.tmp', index=False)
+        os.replace(cls.csv_path() + '.tmp', cls.csv_path())
+        with open(cls._scrape_info_path() + '.tmp', 'w') as f:
+            json.dump({'scraped_at': time.time(), 'page': cls.page}, f)
+        os.replace(cls._scrape_info_path() + '.tmp', cls._scrape_info_path())
+
     @classmethod
     def download(cls):
         df = cls.scrape()
-        df.to_csv(cls.csv_path(), index=False)
+        cls.save(df)
 
 
 class HostpitalBeds(ScrapedTableBase):
     file_name = 'hospital_beds.csv'
     page = 'https://en.wikipedia.org/wiki/List_of_countries_by_hospital_beds'
+    table_match = 'ICU-CCB beds'
 
     @classmethod
     def download(cls):
@@ -275,12 +1148,13 @@ class HostpitalBeds(ScrapedTableBase):
         df_clean = pd.concat([df_clean,
                               df_asia[~df_asia['country'].isin(df_clean['country'])]])
 
-        df_clean.to_csv(cls.csv_path(), index=False)
+        cls.save(df_clean)
 
 
 class EmojiFlags(ScrapedTableBase):
     file_name = 'emoji_flags.csv'
     page = 'https://apps.timwhitlock.info/emoji/tables/iso3166'
+    table_match = 'Unicode'
 
     emoji_col = 'emoji_code'
 
@@ -292,21 +1166,7 @@ class EmojiFlags(ScrapedTableBase):
                             ).drop(columns=['Emoji'])
 
         # rename countries
-        df_filt[COL_REGION] = df_filt[COL_REGION].map({
-            'United States': 'US',
-            'Taiwan': 'Taiwan*',
-            'Macedonia': 'North Macedonia',
-            'Cape Verde': 'Cabo Verde',
-            'Saint Vincent and The Grenadines': 'Saint Vincent and the Grenadines',
-            'Palestinian Territory': 'West Bank and Gaza',
-            'Côte D\'Ivoire': 'Cote d\'Ivoire',
-            'Syrian Arab Republic': 'Syria',
-            'Myanmar': 'Burma',
-            'Viet Nam': 'Vietnam',
-            'Brunei Darussalam': 'Brunei',
-            'Lao People\'s Democratic Republic': 'Laos',
-             'Czech Republic': 'Czechia',
-        }).fillna(df_filt[COL_REGION])
+        df_filt[COL_REGION] = Countries.canonical(df_filt[COL_REGION])
 
         # congo
         df_filt.loc[df_filt['ISO'] == 'CD', COL_REGION] = 'Congo (Kinshasa)'
@@ -317,7 +1177,390 @@ class EmojiFlags(ScrapedTableBase):
             lambda s: ''.join(f'&#{int(hex, 16)};'
                               for hex in re.findall(r'U\+(\S+)', s)))
 
-        df_filt.to_csv(cls.csv_path(), index=False)
+        cls.save(df_filt)
+
+
+def backfill_missing(series, backfill_prev_threshold=50):
+    """
+    Fills 0 diff days between days with large measurements by spreading the
+    future's "catch up" day's cases on the zero days.
+    Per series reference implementation of backfill_missing_matrix (which is the one
+    used), that it's tested against (see test_covid_helpers.py).
+
+    :param series: pandas series of daily cases
+    :param backfill_prev_threshold: number of cases per day after which a 0 day
+        is considered a missing measurement rather than a true zero
+    :return: backfilled series of daily cases
+    """
+    out = [series[0]]
+    missing = 0
+    for cur in series[1:]:
+        if cur == 0:
+            if out[-1] >= backfill_prev_threshold:
+                # a lot of cases on previous appended day
+                missing += 1  # increase missing days
+            else:
+                # normal: too few cases previously, a zero is plausible
+                out.append(cur)
+        elif cur > 0:
+            if missing:
+                # catching up by backfilling from current value
+                out.extend([cur / (missing + 1)] * (missing + 1))
+                missing = 0  # reset missing condition
+            else:
+                # normal: cases accumulating
+                out.append(cur)
+        else:  # cur < 0
+            # some kind of data adjustment (e.g. France)
+            if missing:  # reset missing
+                out.extend([0] * missing)
+                missing = 0
+            out.append(cur)
+
+    if missing:  # finished on missing (no "catch up" day until now)
+        out.extend([0] * missing)
+
+    return pd.Series(out, index=series.index)
+
+
+def backfill_missing_matrix(diffs: np.ndarray, backfill_prev_threshold=50):
+    """
+    Fills 0 diff days between days with large measurements by spreading the
+    future's "catch up" day's cases on the zero days, for all the rows of a
+    (regions x days) matrix at once. Zero days of runs that end with a negative
+    day (some kind of data adjustment, e.g. France) or at the end of the data stay 0.
+    The days are still stepped through (the threshold is checked against the previously
+    emitted, possibly backfilled, value), but each step is a vector operation over regions.
+    Results are identical to applying backfill_missing to each row, and to resuming
+    backfill_missing_resume from a checkpoint (see test_covid_helpers.py).
+
+    :param diffs: 2d array of daily cases (regions x days)
+    :param backfill_prev_threshold: number of cases per day after which a 0 day
+        is considered a missing measurement rather than a true zero
+    :return: 2d float array of backfilled daily cases
+    """
+    n_rows = len(diffs)
+    out, _, _, _ = backfill_missing_resume(
+        diffs, prev=np.full(n_rows, -np.inf), missing=np.zeros(n_rows, dtype=np.int64),
+        backfill_prev_threshold=backfill_prev_threshold)
+    return out
+
+
+def backfill_missing_resume(diffs: np.ndarray, prev: np.ndarray, missing: np.ndarray,
+                            backfill_prev_threshold=50):
+    """
+    backfill_missing_matrix of days that follow previously backfilled days, continuing
+    from the state at the end of the previous days. Runs of missing days at the end of
+    the previous days can be ended by these days, so their values are returned as well.
+
+    :param diffs: 2d array of daily cases of the new days (regions x days)
+    :param prev: last emitted (not missing) value of each region in the previous days,
+        -inf if none
+    :param missing: number of missing days at the end of the previous days of each region
+    :param backfill_prev_threshold: same as in backfill_missing_matrix
+    :return: 2d float array of backfilled daily cases of the new days, value of the
+        previous days' trailing missing days of each region, and prev and missing
+        after the new days
+    """
+    # work on (days x regions) so that each step is on a contiguous row
+    days = np.ascontiguousarray(np.asarray(diffs, dtype=float).T)
+    out = days.copy()
+    n_days = days.shape[0]
+    is_missing = np.zeros(days.shape, dtype=bool)
+    is_catch_up = np.zeros(days.shape, dtype=bool)
+
+    prev = np.array(prev, dtype=float)  # last emitted value
+    missing = np.array(missing, dtype=np.int64)  # current run of missing days
+    for i in range(n_days):
+        cur = days[i]
+        is_missing[i] = (cur == 0) & (prev >= backfill_prev_threshold)
+        is_catch_up[i] = (cur > 0) & (missing > 0)
+        catch_up = is_catch_up[i]
+        out[i, catch_up] = cur[catch_up] / (missing[catch_up] + 1)
+        missing = np.where(is_missing[i], missing + 1, 0)
+        prev = np.where(is_missing[i], prev, out[i])
+
+    # missing days get the value of the day that ended the run if it was a "catch up" day,
+    # and 0 if it was an adjustment (negative / nan) or if the data ended on missing days
+    ends_value = np.vstack([np.where(is_catch_up, out, 0), np.zeros((1, days.shape[1]))])
+    ends_ind = np.where(is_missing, n_days, np.arange(n_days)[:, None])
+    ends_ind = np.minimum.accumulate(ends_ind[::-1], axis=0)[::-1]
+    filled = np.take_along_axis(ends_value, ends_ind, axis=0)
+    out[is_missing] = filled[is_missing]
+    # a run carried from the previous days ends where the new days' first run ends
+    carried = filled[0] if n_days else np.zeros(days.shape[1])
+    return out.T, carried, prev, missing
+
+
+def compact_dtype(values: np.ndarray):
+    """
+    :return: float32 for float values, int32 for int values that fit, otherwise
+        the values' dtype
+    """
+    if np.issubdtype(values.dtype, np.floating):
+        return np.float32
+    if (np.issubdtype(values.dtype, np.integer) and
+            np.abs(values).max(initial=0) < np.iinfo(np.int32).max):
+        return np.int32
+    return values.dtype
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    :return: float32 copy of a float dataframe, int32 copy of an int dataframe
+        whose values fit, otherwise df itself
+    """
+    if len(set(df.dtypes)) != 1:
+        return df
+    dtype = compact_dtype(df.values)
+    return df if dtype == df.dtypes.iloc[0] else df.astype(dtype)
+
+
+class CovidMatrix:
+    """
+    (regions x days) values with a regions index, and the days as a dates index
+    (parsed once) and their source labels (e.g. "1/22/20" JHU columns).
+    Slicing, lagging and diffing are positional and slices are views, and the
+    conversions to dataframes / series are for the edges of the calculations.
+    """
+
+    def __init__(self, values: np.ndarray, index: pd.Index,
+                 dates: pd.DatetimeIndex, labels: pd.Index = None):
+        self.values = values
+        self.index = index
+        self.dates = dates
+        self.labels = labels if labels is not None else pd.Index(
+            [f'{d.month}/{d.day}/{d.year % 100}' for d in dates])
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame, dates: pd.DatetimeIndex = None) -> 'CovidMatrix':
+        """
+        :param df: (regions x days) dataframe with date labels as columns
+        :param dates: the parsed columns if already available
+        """
+        if dates is None:
+            dates = pd.to_datetime(df.columns, format='%m/%d/%y')
+        return cls(df.values, df.index, dates, df.columns)
+
+    def to_df(self) -> pd.DataFrame:
+        """(regions x days) dataframe with the date labels as columns, without copying"""
+        return pd.DataFrame(self.values, index=self.index, columns=self.labels, copy=False)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.values.shape
+
+    def with_values(self, values: np.ndarray) -> 'CovidMatrix':
+        """Matrix of other values for the same regions and days"""
+        return CovidMatrix(values, self.index, self.dates, self.labels)
+
+    def slice_days(self, start=None, stop=None) -> 'CovidMatrix':
+        """Positional days slice, a view of the same values"""
+        day_slice = slice(start, stop)
+        return CovidMatrix(self.values[:, day_slice], self.index,
+                           self.dates[day_slice], self.labels[day_slice])
+
+    def day(self, i) -> pd.Series:
+        """Values of the i-th (positional) day as a series of the regions"""
+        return pd.Series(self.values[:, i], index=self.index, name=self.labels[i])
+
+    def lag(self, n_days=1) -> 'CovidMatrix':
+        """Values of n_days before (nan for the first n_days)"""
+        lagged = np.full(self.shape, np.nan)
+        lagged[:, n_days:] = self.values[:, :self.shape[1] - n_days]
+        return self.with_values(lagged)
+
+    def diff(self, n_days=1) -> 'CovidMatrix':
+        """Difference from n_days before (nan for the first n_days), like DataFrame.diff"""
+        diffs = np.full(self.shape, np.nan)
+        diffs[:, n_days:] = self.values[:, n_days:] - self.values[:, :self.shape[1] - n_days]
+        return self.with_values(diffs)
+
+    def compact(self) -> 'CovidMatrix':
+        """Copy with compact_dtype values"""
+        return self.with_values(self.values.astype(compact_dtype(self.values)))
+
+
+def last_increase_index(cumulative: np.ndarray) -> np.ndarray:
+    """
+    :param cumulative: 2d array of cumulative counts (regions x days)
+    :return: index of the last day with an increase from the previous day per region,
+        -1 for regions without any
+    """
+    increased = np.diff(cumulative, axis=1) > 0
+    last = increased.shape[1] - np.argmax(increased[:, ::-1], axis=1)
+    return np.where(increased.any(axis=1), last, -1)
+
+
+def testing_bias_windows(deaths: np.ndarray, cases: np.ndarray, death_lag: int,
+                         min_window_lag=60, min_window_deaths=300
+                         ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Deaths to cases ratios for all rows (regions) of cumulative deaths and cases matrices
+    (regions x days), using the smallest window (from the left) that has at least
+    min_window_lag days and min_window_deaths deaths, ending at each day.
+    A window ending on a day only depends on the data up to that day, so the result for
+    a longer history can be sliced for any of its prefixes.
+
+    The two pointer window walk is done for all the rows in lockstep (each step moves
+    one pointer of each row), because cumulative deaths can decrease (data corrections)
+    so the window edges can't be looked up by searching the cumulative counts.
+
+    :param deaths: 2d array of cumulative deaths (regions x days)
+    :param cases: 2d array of cumulative cases (regions x days)
+    :param death_lag: days between a case being reported and reported death
+    :param min_window_lag: minimal window length, scalar or array per region
+        (so that parameter sweeps can be done by stacking the same data for each value)
+    :param min_window_deaths: minimal window deaths, scalar or array per region
+    :return: 2d arrays of ratios (regions x days), and of whether a day had a window
+    """
+    n_rows = len(deaths)
+    win_lag = np.broadcast_to(np.asarray(min_window_lag), (n_rows,))
+    ratios, has_window, _, _, _ = testing_bias_windows_resume(
+        deaths, cases,
+        left=np.full(n_rows, death_lag),
+        right=death_lag + win_lag.astype(int),
+        shrinking=np.zeros(n_rows, dtype=bool),
+        death_lag=death_lag, start=0,
+        min_window_lag=min_window_lag, min_window_deaths=min_window_deaths)
+    return ratios, has_window
+
+
+def testing_bias_windows_resume(deaths: np.ndarray, cases: np.ndarray, left: np.ndarray,
+                                right: np.ndarray, shrinking: np.ndarray, death_lag: int,
+                                start: int, min_window_lag=60, min_window_deaths=300):
+    """
+    testing_bias_windows of the days from start, continuing the windows walk from the
+    pointers it stopped at when the history ended on that day (the windows of the
+    previous days don't change when days are added).
+
+    :param deaths: 2d array of cumulative deaths (regions x days), of all the days
+    :param cases: 2d array of cumulative cases (regions x days), of all the days
+    :param left: windows' left pointers of each region
+    :param right: windows' right pointers of each region
+    :param shrinking: whether each region's window is shrinking from the left
+    :param start: first day to calculate
+    :return: 2d arrays of ratios and of whether a day had a window (regions x days from
+        start), and the left, right and shrinking pointers state after the last day
+    """
+    deaths = np.asarray(deaths)
+    cases = np.asarray(cases, dtype=float)
+    n_rows, n_days = deaths.shape
+    rows = np.arange(n_rows)
+    win_lag = np.broadcast_to(np.asarray(min_window_lag), (n_rows,))
+    win_deaths = np.broadcast_to(np.asarray(min_window_deaths), (n_rows,))
+    ratios = np.zeros((n_rows, n_days - start))
+    has_window = np.zeros(ratios.shape, dtype=bool)
+
+    left = np.array(left)
+    right = np.array(right)
+    shrinking = np.array(shrinking, dtype=bool)
+    active = right <= n_days - 1
+    while active.any():
+        r = np.minimum(right, n_days - 1)
+        diff_deaths = deaths[rows, r] - deaths[rows, np.minimum(left, n_days - 1)]
+        # grow window to the right if needed
+        grow = active & ~shrinking & (((r - left) < win_lag) | (diff_deaths < win_deaths))
+        shrinking |= active & ~grow
+        # shrink window from the left if possible, otherwise calculate the ratio
+        shrink = shrinking & ((r - left) > win_lag) & (diff_deaths > win_deaths)
+        done = shrinking & ~shrink
+        diff_cases = (cases[rows[done], r[done] - death_lag] -
+                      cases[rows[done], left[done] - death_lag])
+        ratios[rows[done], r[done] - start] = diff_deaths[done] / diff_cases
+        has_window[rows[done], r[done] - start] = True
+        # advance left every time to prevent infinite loop
+        left += shrinking
+        shrinking &= ~done
+        right += grow
+        active &= (right <= n_days - 1)
+
+    return ratios, has_window, left, right, shrinking
+
+
+def testing_biases_matrix(deaths: np.ndarray, cases: np.ndarray, ifrs: np.ndarray,
+                          death_lag: int, min_window_lag=60, min_window_deaths=300,
+                          windows: Tuple[np.ndarray, np.ndarray] = None):
+    """
+    Testing biases for all rows (regions) of cumulative deaths and cases matrices
+    (regions x days), from the ratios of testing_bias_windows, falling back to the
+    overall ratio for regions without enough deaths.
+
+    :param deaths: 2d array of cumulative deaths (regions x days)
+    :param cases: 2d array of cumulative cases (regions x days)
+    :param ifrs: 1d array of IFRs per region
+    :param death_lag: days between a case being reported and reported death
+    :param min_window_lag: minimal window length, scalar or array per region
+    :param min_window_deaths: minimal window deaths, scalar or array per region
+    :param windows: optional precomputed testing_bias_windows result for these rows
+        (can be of a longer history, only the first days are used)
+    :return: 2d float array of biases (regions x days), values below 1 are not clipped
+    """
+    deaths = np.asarray(deaths)
+    cases = np.asarray(cases, dtype=float)
+    n_rows, n_days = deaths.shape
+    rows = np.arange(n_rows)
+    ifrs = np.broadcast_to(np.asarray(ifrs, dtype=float), (n_rows,))
+    win_deaths = np.broadcast_to(np.asarray(min_window_deaths), (n_rows,))
+    if windows is None:
+        windows = testing_bias_windows(
+            deaths, cases, death_lag, min_window_lag, min_window_deaths)
+    ratios, has_window = windows[0][:, :n_days], windows[1][:, :n_days]
+
+    biases = np.ones(deaths.shape)
+    np.divide(ratios, ifrs[:, None], out=biases, where=has_window)
+
+    # short circuit and fallback if not enough data for windowed calculations
+    last_deaths = deaths[:, -1]
+    fallback = last_deaths < win_deaths
+    biases[fallback] = 1
+    has_deaths = fallback & (last_deaths > 0)
+    biases[has_deaths] = ((last_deaths[has_deaths] / cases[has_deaths, -1])
+                          / ifrs[has_deaths])[:, None]
+
+    # use first non 1 (initialised) value to fill the initial values
+    windowed = ~fallback & (biases != 1).any(axis=1)
+    fill_ind = np.argmax(biases != 1, axis=1)
+    fill_mask = windowed[:, None] & (np.arange(n_days) < fill_ind[:, None])
+    biases[fill_mask] = np.broadcast_to(biases[rows, fill_ind][:, None], biases.shape)[fill_mask]
+    return biases
+
+
+def recovery_recurrence(cases: np.ndarray, recovery_lagged9_rate: float,
+                        recs_before: np.ndarray = None) -> np.ndarray:
+    """
+    Estimated recovered of all rows (regions) of cumulative cases ratios (regions x days),
+    each day's recoveries are the rate of the cases that weren't recovered 9 days before,
+    and are clipped by the day's cases.
+
+    :param cases: 2d array of cumulative cases ratios (regions x days)
+    :param recovery_lagged9_rate: see Model.recovery_lagged9_rate
+    :param recs_before: optional recovered of the first days (regions x days), from
+        a previous calculation for a shorter history, only the following days are calculated
+    :return: 2d array of recovered ratios (regions x days)
+    """
+    # work on (days x regions) so that each step is on a contiguous row
+    cases = np.ascontiguousarray(np.asarray(cases, dtype=float).T)
+    recs = np.empty_like(cases)
+    start = 0
+    if recs_before is not None:
+        start = recs_before.shape[1]
+        recs[:start] = recs_before.T
+
+    # https://covid19dashboards.com/outstanding_cases/#Appendix:-Methodology-of-Predicting-Recovered-Cases
+    zeros = cases[0] * 0  # this is to have consistent nans
+    for day in range(start, len(cases)):
+        # previous day
+        prev_rec = recs[day - 1] if day > 0 else zeros
+        # lagged recoveries
+        tot_lagged_9 = cases[day - 9] if day >= 9 else zeros
+        new_recs = recs[day]
+        np.subtract(tot_lagged_9, prev_rec, out=new_recs)
+        new_recs *= recovery_lagged9_rate
+        new_recs += prev_rec
+        # clip recoveries by current cases
+        np.copyto(new_recs, cases[day], where=new_recs > cases[day])
+    return recs.T
 
 
 class CovidData:
@@ -329,101 +1572,324 @@ class CovidData:
 
     PER_100K_SUFFIX = '.per100k'
 
-    dft_cases_raw = SourceData.get_covid_dataframe('confirmed')
-    dft_deaths_raw = SourceData.get_covid_dataframe('deaths')
-    # dft_recovered = SourceData.get_covid_dataframe('recovered')
-    dt_cols_all = SourceData.get_dates(dft_cases_raw)
-
-    cur_date = pd.to_datetime(dt_cols_all[-1]).date().isoformat()
+    # source data, downloaded lazily on first access (or explicitly via load())
+    load_timeouts = {'confirmed': 300, 'deaths': 300, 'owid': 120, 'beds': 60, 'emoji': 60}
+    dft_cases_raw: pd.DataFrame = _LoadedAttribute()
+    dft_deaths_raw: pd.DataFrame = _LoadedAttribute()
+    # (regions x dates) sums, regions are countries (sums of their provinces' numbers)
+    # unless region_labels is overridden
+    dft_cases_regions: pd.DataFrame = _LoadedAttribute()
+    dft_deaths_regions: pd.DataFrame = _LoadedAttribute()
+    dt_cols_all: pd.Index = _LoadedAttribute()
+    dates_all: pd.DatetimeIndex = _LoadedAttribute()  # parsed dt_cols_all
+    cur_date: str = _LoadedAttribute()
+    countries: Countries = _LoadedAttribute()
+    region_countries: pd.Series = _LoadedAttribute()  # country of each region
+    data_hash: str = _LoadedAttribute()
 
     PREV_LAG = 5
 
+    # max absolute error relative to each column's largest value of the compact mode's
+    # tables vs. the full precision tables (see __init__ and check_compact_mode)
+    compact_rtol = 1e-3
+
     # modeling constants
     ## testing bias
     death_lag = 8
 
-    def __init__(self, days_offset=0):
+    @classmethod
+    @func_cache
+    def load(cls) -> dict:
+        """
+        Downloads and prepares the source data. Called implicitly on first access to
+        any of the source data attributes, the result is cached for the process.
+
+        :return: dict of source data attributes by name
+        """
+        sources = load_concurrently(
+            {'confirmed': functools.partial(cls.source_dataframe, 'confirmed'),
+             'deaths': functools.partial(cls.source_dataframe, 'deaths'),
+             # fetched alongside to warm up their caches for the tables
+             'owid': OWID.latest_snapshot,
+             'beds': HostpitalBeds.load,
+             'emoji': EmojiFlags.load},
+            timeouts=cls.load_timeouts,
+            required=['confirmed', 'deaths'])
+        dft_cases_raw = sources['confirmed']
+        dft_deaths_raw = sources['deaths']
+        dt_cols_all = SourceData.get_dates(dft_cases_raw)
+        dates_all = pd.to_datetime(dt_cols_all, format='%m/%d/%y')
+
+        def sum_regions(df):  # only the numbers, e.g. not the Lat / Long columns
+            return df[dt_cols_all].groupby(cls.region_labels(df)).sum()
+
+        return {'dft_cases_raw': dft_cases_raw,
+                'dft_deaths_raw': dft_deaths_raw,
+                'dft_cases_regions': sum_regions(dft_cases_raw),
+                'dft_deaths_regions': sum_regions(dft_deaths_raw),
+                'dt_cols_all': dt_cols_all,
+                'dates_all': dates_all,
+                'cur_date': dates_all[-1].date().isoformat(),
+                'countries': Countries(dft_cases_raw[COL_REGION]),
+                'region_countries': (dft_cases_raw[COL_REGION]
+                                     .groupby(cls.region_labels(dft_cases_raw)).first()),
+                'data_hash': hashlib.sha256(b''.join(
+                    pd.util.hash_pandas_object(df).to_numpy().tobytes()
+                    for df in [dft_cases_raw, dft_deaths_raw])).hexdigest()}
+
+    @classmethod
+    def source_dataframe(cls, name) -> pd.DataFrame:
+        """
+        :param name: 'confirmed' or 'deaths'
+        :return: raw time series dataframe of the source's rows (with the meta_cols
+            and dates columns)
+        """
+        return SourceData.get_covid_dataframe(name)
+
+    @classmethod
+    def region_labels(cls, df: pd.DataFrame) -> pd.Series:
+        """
+        :param df: raw time series dataframe
+        :return: the region label of each row, rows are summed by these labels
+        """
+        return df[COL_REGION]
+
+    @classmethod
+    def reload(cls):
+        """Drops the cached source data so that it's downloaded again on next access"""
+        cls.load.cache_clear()
+        cls.extra_data.cache_clear()
+        cls._history.cache_clear()
+        cls._testing_bias_windows.cache_clear()
+
+    @classmethod
+    def history(cls, compact=False) -> dict:
+        """
+        Intermediates of the full history, computed once and shared by the instances
+        of all days_offsets, which take views of their first days (without copying).
+
+        :param compact: whether to return the compact (float32 / int32) copies, the full
+            precision intermediates they are made of are not kept
+        :return: dict of (countries x all dates) CovidMatrix, and last reports dates
+        """
+        return cls._history(bool(compact))  # same cache key however it's called
+
+    @classmethod
+    @func_cache
+    def _history(cls, compact: bool) -> dict:
+        history = cls._calculate_history()
+        if compact:
+            return {name: m.compact() if isinstance(m, CovidMatrix) else m
+                    for name, m in history.items()}
+        return history
+
+    @classmethod
+    def _calculate_history(cls) -> dict:
+        cases_backfilled = CovidMatrix.from_df(
+            cls._cases_with_backfilled_unreported_days(), dates=cls.dates_all)
+        return {'cases_backfilled': cases_backfilled,
+                'cases_backfilled_new': cases_backfilled.diff(),
+                'deaths': CovidMatrix.from_df(cls.dft_deaths_regions, dates=cls.dates_all),
+                'last_dates': cls._last_dates()}
+
+    @classmethod
+    @func_cache
+    def _testing_bias_windows(cls, min_window_lag, min_window_deaths, compact=False):
+        # in compact mode from the compact history, so that full precision isn't kept
+        history = cls.history(compact)
+        deaths, cases = history['deaths'].values, history['cases_backfilled'].values
+
+        # only the new days are calculated for regions whose previous days didn't change
+        checkpoint = Checkpoint(
+            f'{cls.__name__}.testing_bias_windows.{min_window_lag}.{min_window_deaths}'
+            f'{".compact" if compact else ""}',
+            params={'death_lag': cls.death_lag,
+                    'code': Checkpoint.code_hash(testing_bias_windows_resume)},
+            index=history['deaths'].index, columns=history['deaths'].labels,
+            inputs={'deaths': deaths, 'cases': cases})
+        ratios = np.zeros(deaths.shape)
+        has_window = np.zeros(deaths.shape, dtype=bool)
+        left = np.full(len(deaths), cls.death_lag)
+        right = left + int(min_window_lag)
+        shrinking = np.zeros(len(deaths), dtype=bool)
+        checkpoint.restore(ratios=ratios, has_window=has_window,
+                           left=left, right=right, shrinking=shrinking)
+        for rows, start in checkpoint.groups():
+            (ratios[rows, start:], has_window[rows, start:],
+             left[rows], right[rows], shrinking[rows]) = RowShards.map(
+                testing_bias_windows_resume,
+                [deaths[rows], cases[rows], left[rows], right[rows], shrinking[rows]],
+                death_lag=cls.death_lag,
+                start=start,
+                min_window_lag=min_window_lag,
+                min_window_deaths=min_window_deaths)
+        checkpoint.save(ratios=ratios, has_window=has_window,
+                        left=left, right=right, shrinking=shrinking)
+        if compact:
+            ratios = ratios.astype(np.float32)
+        return ratios, has_window
+
+    @classmethod
+    @func_cache
+    def extra_data(cls) -> pd.DataFrame:
+        """
+        Per country data from the other sources, mapped once into the countries index
+        so that it can be joined to the tables positionally.
+        """
+        countries = cls.countries
+        ifr_s, population_s, icu_percent_s = AgeAdjustedData.load()
+        owid_df = OWID.latest_snapshot()
+        return pd.DataFrame({
+            'Continent': countries.continent,
+            'emoji_flag': countries.align(
+                EmojiFlags.load().set_index(COL_REGION)[EmojiFlags.emoji_col]),
+            'age_adjusted_ifr': countries.align(ifr_s),
+            'population': countries.align(population_s),
+            'age_adjusted_icu_percentage': countries.align(icu_percent_s),
+            'icu_capacity_per100k': countries.align(cls.beds_df()['icu_per_100k']),
+            'owid_icu_per_100k': countries.align(owid_df[OWID.icu_per_mil_col].dropna()) / 10,
+            'owid_part_vaccinated_ratio':
+                countries.align(owid_df[OWID.vaccinated_percent_col].dropna()) / 100,
+            'owid_full_vaccinated_ratio':
+                countries.align(owid_df[OWID.fully_vaccinated_percent_col].dropna()) / 100,
+            'owid_total_vaccinations_ratio':
+                countries.align(owid_df[OWID.vaccinations_percent_col].dropna()) / 100,
+        })
+
+    def __init__(self, days_offset=0, compact=False):
+        """
+        :param days_offset: 0 or negative number of days back in history to use as
+            the current day
+        :param compact: whether to store the (countries x days) matrices as float32,
+            or int32 for counts (calculations are still done in float64 and only
+            their results are stored compactly). This halves their memory (the
+            shared full history included, it isn't kept in full precision), while peak
+            memory only drops by about a third since the calculations are full precision.
+            The tables' errors relative to each column's largest value stay within
+            compact_rtol (see check_compact_mode).
+        """
         assert days_offset <= 0, 'day_offest can only be 0 or negative (in the past)'
-        self.dt_cols = self.dt_cols_all[:(len(self.dt_cols_all) + days_offset)]
-        self.dft_cases_backfilled = self._cases_with_backfilled_unreported_days()[self.dt_cols]
-        self.dft_deaths = self.dft_deaths_raw.groupby(COL_REGION).sum()[self.dt_cols]
-        self.dfc_cases = self.dft_cases_backfilled[self.dt_cols[-1]]
-        self.dfc_deaths = self.dft_deaths[self.dt_cols[-1]]
+        self.compact = compact
+        n_days = len(self.dt_cols_all) + days_offset
+        self.dt_cols = self.dt_cols_all[:n_days]
+        self.dates = self.dates_all[:n_days]
+        # views of the shared history
+        history = self.history(compact)
+        self.cases_backfilled = history['cases_backfilled'].slice_days(stop=n_days)
+        self.cases_backfilled_new = history['cases_backfilled_new'].slice_days(stop=n_days)
+        self.deaths = history['deaths'].slice_days(stop=n_days)
+        self.dft_cases_backfilled = self.cases_backfilled.to_df()
+        self.dft_deaths = self.deaths.to_df()
+        self.dfc_cases = self.cases_backfilled.day(-1)
+        self.dfc_deaths = self.deaths.day(-1)
 
         # to be calculated later
         self.testing_biases_dft: pd.DataFrame = None
+        self.cases_est: CovidMatrix = None
         self.cases_est_dft: pd.DataFrame = None
 
-    def _cases_with_backfilled_unreported_days(self):
-
-        def backfill_missing(series, backfill_prev_threshold=50):
-            """
-            Fills 0 diff days between days with large measurements by spreading the
-            future's "catch up" day's cases on the zero days.
-
-            :param series: pandas series of daily cases
-            :param backfill_prev_threshold: number of cases per day after which a 0 day
-                is considered a missing measurement rather than a true zero
-            :return: backfilled series of daily cases
-            """
-            out = [series[0]]
-            missing = 0
-            for cur in series[1:]:
-                if cur == 0:
-                    if out[-1] >= backfill_prev_threshold:
-                        # a lot of cases on previous appended day
-                        missing += 1  # increase missing days
-                    else:
-                        # normal: too few cases previously, a zero is plausible
-                        out.append(cur)
-                elif cur > 0:
-                    if missing:
-                        # catching up by backfilling from current value
-                        out.extend([cur / (missing + 1)] * (missing + 1))
-                        missing = 0  # reset missing condition
-                    else:
-                        # normal: cases accumulating
-                        out.append(cur)
-                else:  # cur < 0
-                    # some kind of data adjustment (e.g. France)
-                    if missing:  # reset missing
-                        out.extend([0] * missing)
-                        missing = 0
-                    out.append(cur)
-
-            if missing:  # finished on missing (no "catch up" day until now)
-                out.extend([0] * missing)
+    def __disk_cache_key__(self):
+        return (type(self).__name__, self.data_hash, len(self.dt_cols), self.compact,
+                self.death_lag, Model.__disk_cache_key__())
+
+    def _stored(self, df: pd.DataFrame) -> pd.DataFrame:
+        """df as it should be kept according to the compact mode"""
+        return compact_frame(df) if self.compact else df
+
+    @classmethod
+    def check_compact_mode(cls, days_offset=0, rtol=None) -> pd.Series:
+        """
+        Compares the compact mode's projections table to the full precision one.
 
-            return pd.Series(out, index=series.index)
+        :param days_offset: days offset of the compared instances
+        :param rtol: tolerance, default compact_rtol
+        :return: max absolute error relative to the column's largest value per column
+        :raises AssertionError: if a column's error is above the tolerance or different
+            values are missing
+        """
+        rtol = cls.compact_rtol if rtol is None else rtol
+        full = cls(days_offset).table_with_projections()
+        compact = cls(days_offset, compact=True).table_with_projections()
+        full = full.select_dtypes('number')
+        compact = compact.loc[full.index, full.columns].astype(float)
+        assert (full.isna() == compact.isna()).all().all(), 'different missing values'
+        errors = (compact - full).abs().max() / full.abs().max().replace(0, 1)
+        above = errors[errors > rtol]
+        assert not len(above), f'above tolerance: {above.to_dict()}'
+        return errors
 
-        cases = self.dft_cases_raw.groupby(self.COL_REGION).sum()[self.dt_cols_all]
+    @classmethod
+    def _cases_with_backfilled_unreported_days(cls):
+        cases = cls.dft_cases_regions
         diffs = cases.diff(axis=1)
         diffs.iloc[:, 0] = cases.iloc[:, 0]  # replace resulting nans in first date's data
 
-        fixed = diffs.apply(backfill_missing, axis=1)
+        # only the new days are backfilled for regions whose previous days didn't change
+        checkpoint = Checkpoint(
+            f'{cls.__name__}.backfill',
+            params={'code': Checkpoint.code_hash(backfill_missing_resume)},
+            index=diffs.index, columns=diffs.columns, inputs={'diffs': diffs.values})
+        fixed = np.empty(diffs.shape)
+        prev = np.full(len(diffs), -np.inf)
+        missing = np.zeros(len(diffs), dtype=np.int64)
+        checkpoint.restore(fixed=fixed, prev=prev, missing=missing)
+        for rows, start in checkpoint.groups():
+            missing_before = missing[rows]
+            fixed[rows, start:], carried, prev[rows], missing[rows] = RowShards.map(
+                backfill_missing_resume, [diffs.values[rows, start:], prev[rows], missing_before])
+            # runs of missing days that were at the end of the previous days
+            run_rows, run_days = np.nonzero(np.arange(start) >= start - missing_before[:, None])
+            fixed[np.flatnonzero(rows)[run_rows], run_days] = carried[run_rows]
+        checkpoint.save(fixed=fixed, prev=prev, missing=missing)
+
+        fixed = pd.DataFrame(fixed, index=diffs.index, columns=diffs.columns)
         imputed_cases = fixed.cumsum(axis=1)
         return imputed_cases
 
     def lagged_cases(self, lag=PREV_LAG):
-        return self.dft_cases_backfilled[self.dt_cols[-lag]]
+        return self.cases_backfilled.day(-lag)
 
     def lagged_deaths(self, lag=PREV_LAG):
-        return self.dft_deaths[self.dt_cols[-lag]]
+        return self.deaths.day(-lag)
 
     def add_last_dates(self, df):
+        last_dates = self.history(self.compact)['last_dates']
+        df['last_case_date'] = last_dates['last_case_date']
+        df['last_death_date'] = last_dates['last_death_date']
+        return df
 
-        def last_date(s):
-            non_zero_s = s[4:][s[4:] > 0]
-            if len(non_zero_s):
-                return pd.to_datetime(non_zero_s.index[-1]).date().isoformat()
-            else:
-                return float('nan')
+    @classmethod
+    def _last_dates(cls) -> pd.DataFrame:
+        iso_dates = np.asarray(cls.dates_all.strftime('%Y-%m-%d'))
 
-        df['last_case_date'] = (self.dft_cases_raw.groupby(COL_REGION).sum().diff(axis=1)
-                                .apply(last_date, axis=1))
-        df['last_death_date'] = (self.dft_deaths_raw.groupby(COL_REGION).sum().diff(axis=1)
-                                 .apply(last_date, axis=1))
-        return df
+        def last_dates(df):
+            # the first two days are excluded (as they were when the sums had Lat / Long)
+            last = last_increase_index(df.values[:, 1:]) + 1
+            return pd.Series(iso_dates[last], index=df.index).where(last > 0)
+
+        return pd.DataFrame({'last_case_date': last_dates(cls.dft_cases_regions),
+                             'last_death_date': last_dates(cls.dft_deaths_regions)})
+
+    def reporting_staleness(self, window=14) -> pd.DataFrame:
+        """
+        Per country reporting staleness as of this instance's last day, from the reported
+        (not backfilled) numbers, e.g. for flagging countries that stopped reporting.
+
+        :param window: number of recent days in which to count the days without reports
+        :return: dataframe with days since last reported new cases / deaths
+            (nan if never reported) and numbers of days without new cases / deaths
+            reported in the window
+        """
+        n_days = len(self.dt_cols)
+        staleness = {}
+        for name, df in [('case', self.dft_cases_regions),
+                         ('death', self.dft_deaths_regions)]:
+            values = df.values[:, :n_days]
+            last = last_increase_index(values)
+            staleness[f'days_since_last_{name}'] = np.where(last >= 0, n_days - 1 - last, np.nan)
+            staleness[f'zero_{name}_days'] = (
+                    np.diff(values[:, -(window + 1):], axis=1) <= 0).sum(axis=1)
+        return pd.DataFrame(staleness, index=self.dft_cases_regions.index)
 
     def overview_table(self):
         df_table = (pd.DataFrame({'Cases.total': self.dfc_cases,
@@ -438,7 +1904,8 @@ class CovidData:
                     df_table[c] - df_table[f'{c}.prev']).clip(0)  # DATA BUG
         df_table['Fatality Rate'] = (100 * df_table['Deaths.total'] /
                                      df_table['Cases.total']).round(1)
-        df_table['Continent'] = df_table[COL_REGION].map(SourceData.mappings['map.continent'])
+        df_table['Continent'] = self.countries.take(
+            self.countries.continent, self._country_codes(df_table[COL_REGION])).to_numpy()
 
         # remove problematic
         df_table = df_table[~df_table[COL_REGION].isin(['Cape Verde', 'Cruise Ship', 'Kosovo'])]
@@ -447,13 +1914,19 @@ class CovidData:
     @classmethod
     def beds_df(cls):
         df_beds = HostpitalBeds.load().rename(columns={'country': COL_REGION})
-        df_beds[COL_REGION] = df_beds[COL_REGION].map({
-            'United States': 'US',
-            'United Kingdom (more)': 'United Kingdom',
-            'Czech Republic': 'Czechia',
-        }).fillna(df_beds[COL_REGION])
+        df_beds[COL_REGION] = Countries.canonical(df_beds[COL_REGION])
         return df_beds.set_index(COL_REGION)
 
+    def _country_codes(self, regions) -> np.ndarray:
+        """codes of the regions' countries in the countries index (-1 if unknown)"""
+        return self.countries.codes(self.region_countries.reindex(regions))
+
+    def _extra_data_for(self, regions: pd.Index) -> pd.DataFrame:
+        """the regions' countries' rows of extra_data, indexed by regions"""
+        extra = self.countries.take(self.extra_data(), self._country_codes(regions))
+        extra.index = regions
+        return extra
+
     def overview_table_with_extra_data(self):
         df = (self.overview_table()
               .drop(['Cases.total.prev', 'Deaths.total.prev'], axis=1)
@@ -461,87 +1934,53 @@ class CovidData:
               .sort_values('Cases.new', ascending=False))
         df['Fatality Rate'] /= 100
 
+        # positional join of the other sources' data
+        extra = self._extra_data_for(df.index)
+
         # add emoji flags
-        df['emoji_flag'] = EmojiFlags.load().set_index(COL_REGION)[EmojiFlags.emoji_col]
-        df['emoji_flag'] = df['emoji_flag'].fillna('')
+        df['emoji_flag'] = extra['emoji_flag'].fillna('')
 
         # last dates
         df = self.add_last_dates(df)
 
         # age adjusted data
-        (df['age_adjusted_ifr'],
-         df['population'],
-         df['age_adjusted_icu_percentage']) = AgeAdjustedData.load()
+        for col in ['age_adjusted_ifr', 'population', 'age_adjusted_icu_percentage']:
+            df[col] = extra[col]
 
         # add per population columns
-        df.dropna(subset=['population'], inplace=True)
+        has_population = df['population'].notna().to_numpy()
+        df, extra = df[has_population], extra[has_population]
         for col in [self.CASES_TOT, self.DEATHS_TOT, self.CASES_NEW, self.DEATHS_NEW]:
             df[f'{col}{self.PER_100K_SUFFIX}'] = df[col] * 1e5 / df['population']
 
         # add ICU capacity data
-        df_beds = self.beds_df()
-        df['icu_capacity_per100k'] = df_beds['icu_per_100k']
+        df['icu_capacity_per100k'] = extra['icu_capacity_per100k']
 
         # add OWID data
-        owid_df = OWID.latest_snapshot()
-        df['owid_icu_per_100k'] = owid_df[OWID.icu_per_mil_col].dropna() / 10
-        df['owid_part_vaccinated_ratio'] = owid_df[OWID.vaccinated_percent_col].dropna() / 100
-        df['owid_full_vaccinated_ratio'] = owid_df[OWID.fully_vaccinated_percent_col].dropna() / 100
-        df['owid_total_vaccinations_ratio'] = owid_df[OWID.vaccinations_percent_col].dropna() / 100
+        for col in ['owid_icu_per_100k', 'owid_part_vaccinated_ratio',
+                    'owid_full_vaccinated_ratio', 'owid_total_vaccinations_ratio']:
+            df[col] = extra[col]
 
         return df
 
+    @DiskCache.memoize
     def calculate_testing_biases_dft(
             self, ifrs: pd.Series, min_window_lag = 60, min_window_deaths = 300
     ) -> pd.DataFrame:
-        deaths_dft = self.dft_deaths
-        cases_dft = self.dft_cases_backfilled
-
-        def biases_vec(country: str) -> pd.Series:
-            d_vec = deaths_dft.loc[country].values
-            c_vec = cases_dft.loc[country].values
-            ifr = ifrs.loc[country]
-            left, right = self.death_lag, self.death_lag + min_window_lag
-            biases = np.ones_like(c_vec)
-
-            # short circuit and fallback if not enough data for windowed calculations
-            if d_vec[-1] < min_window_deaths:
-                if d_vec[-1] > 0:
-                    biases[:] = (d_vec[-1] / c_vec[-1]) / ifr
-                else:
-                    pass  # just return ones
-
-            else:
-                def diff_deaths(right, left):
-                    return d_vec[right] - d_vec[left]
-
-                def diff_cases(right, left):
-                    return c_vec[right - self.death_lag] - c_vec[left - self.death_lag]
-
-                while right <= (len(c_vec) - 1):
-                    if ((right - left) < min_window_lag or
-                            diff_deaths(right, left) < min_window_deaths):
-                        # grow window to the right if needed
-                        right += 1
-                        continue
-
-                    while ((right - left) > min_window_lag and
-                           diff_deaths(right, left) > min_window_deaths):
-                        # shrink window from the left if possible
-                        left += 1
-
-                    biases[right] = ((diff_deaths(right, left) / diff_cases(right, left))
-                                     / ifr)
-                    # advance left every time to prevent infinite loop
-                    left += 1
-
-                # use first non 1 (initialised) value to fill the initial values
-                fill_ind = np.where(biases != 1)[0][0]
-                biases[:fill_ind] = biases[fill_ind]
-
-            return pd.Series(biases, index=self.dt_cols)
-
-        testing_biases_dft = ifrs.index.to_series().apply(biases_vec)
+        # windows of the full history, sliced to this instance's days
+        rows = self.deaths.index.get_indexer(ifrs.index)
+        ratios, has_window = self._testing_bias_windows(
+            min_window_lag, min_window_deaths, self.compact)
+        biases = testing_biases_matrix(
+            deaths=self.deaths.values[rows],
+            cases=self.cases_backfilled.values[rows],
+            ifrs=ifrs.values,
+            death_lag=self.death_lag,
+            min_window_deaths=min_window_deaths,
+            windows=(ratios[rows], has_window[rows]))
+        if self.compact:
+            biases = biases.astype(np.float32)
+        testing_biases_dft = pd.DataFrame(biases, index=ifrs.index, columns=self.dt_cols)
         testing_biases_dft[testing_biases_dft < 1] = 1
         return testing_biases_dft
 
@@ -562,14 +2001,22 @@ class CovidData:
             df['age_adjusted_ifr'])
 
         # adjust daily cases by closest approximation of testing bias at that point
-        cases_dft = self.dft_cases_backfilled
-        self.cases_est_dft = (cases_dft.diff(axis=1) * self.testing_biases_dft
-                              ).cumsum(axis=1).fillna(0).astype(int)
+        new_cases = self.cases_backfilled_new
+        biases = np.full(new_cases.shape, np.nan)  # for countries without a bias
+        biases[new_cases.index.get_indexer(self.testing_biases_dft.index)] = (
+            self.testing_biases_dft.values)
+        new_cases_est = new_cases.values * biases
+        # nans are skipped in the sum, and are 0 themselves
+        cases_est = np.where(np.isnan(new_cases_est), 0,
+                             np.nancumsum(new_cases_est, axis=1)).astype(int)
+        self.cases_est = new_cases.with_values(cases_est.astype(compact_dtype(cases_est))
+                                         if self.compact else cases_est)
+        self.cases_est_dft = self.cases_est.to_df()
 
         df['current_testing_bias'] = self.testing_biases_dft.iloc[:, -1]
 
         # total cases
-        df[f'{self.CASES_TOT}.est'] = self.cases_est_dft[self.dt_cols[-1]]
+        df[f'{self.CASES_TOT}.est'] = self.cases_est.day(-1)
         df[f'{self.CASES_TOT}{self.PER_100K_SUFFIX}.est'] = (
                 df[f'{self.CASES_TOT}.est'] * 1e5 / df['population'])
 
@@ -593,31 +2040,43 @@ class CovidData:
                                 })
 
     def smoothed_growth_rates(self, n_days):
-        recent_dates = self.dt_cols[-n_days:]
+        stats = self.growth_rate_stats(windows=(n_days,))
+        return stats[f'growth_rate.{n_days}d'], stats[f'growth_rate_std.{n_days}d']
 
-        cases = self.cases_est_dft[recent_dates] + 1  # with pseudo counts
+    def growth_rate_stats(self, windows=(5, 7, 14, 28)) -> pd.DataFrame:
+        """
+        Weighted means and standard deviations of the daily growth rates of estimated
+        cases over several numbers of recent days, all from the same cumulative sums.
 
-        diffs = self.cases_est_dft.diff(axis=1)[recent_dates]
+        :param windows: numbers of most recent days
+        :return: dataframe with "growth_rate.{n}d" and "growth_rate_std.{n}d" columns
+        """
+        max_days = max(windows)
+        recent = self.cases_est.values[:, -(max_days + 1):].astype(float)
+        cases = recent[:, 1:] + 1  # with pseudo counts
+        diffs = np.diff(recent, axis=1)
         diffs[diffs < 0] = 0  # total cases cannot go down
 
-        cases, diffs = cases.T, diffs.T  # broadcasting works correctly this way
-
-        # daily rate is new / (total - new)
-        daily_growth_rates = cases / (cases - diffs)
+        # daily rate is new / (total - new), the growth is the rate - 1
+        growth = diffs / (cases - diffs)
 
         # dates with larger number of cases have higher sampling accuracy
-        # so their measurement deserve more confidence
-        sampling_weights = (cases / cases.sum(0))
-
-        weighted_mean = (daily_growth_rates * sampling_weights).sum(0)
-
-        weighted_std = ((daily_growth_rates - weighted_mean).pow(2) *
-                        sampling_weights).sum(0).pow(0.5)
-
-        return weighted_mean - 1, weighted_std
+        # so their measurement deserve more confidence, so the sums are weighted by cases
+        # and accumulated from the last day, so that each window is a lookup
+        weights_sums = np.cumsum(cases[:, ::-1], axis=1)
+        growth_sums = np.cumsum((cases * growth)[:, ::-1], axis=1)
+        growth_sq_sums = np.cumsum((cases * growth ** 2)[:, ::-1], axis=1)
+
+        stats = {}
+        for n in windows:
+            weighted_mean = growth_sums[:, n - 1] / weights_sums[:, n - 1]
+            weighted_var = growth_sq_sums[:, n - 1] / weights_sums[:, n - 1] - weighted_mean ** 2
+            stats[f'growth_rate.{n}d'] = weighted_mean
+            stats[f'growth_rate_std.{n}d'] = np.sqrt(weighted_var.clip(0))  # rounding errors
+        return pd.DataFrame(stats, index=self.cases_est.index)
 
     def table_with_current_rates_and_ratios(
-            self) -> Tuple[pd.DataFrame, List[pd.Series], List[pd.Series]]:
+            self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
         df = self.table_with_estimated_cases()
 
         df['affected_ratio'] = df['Cases.total'] / df['population']
@@ -626,8 +2085,8 @@ class CovidData:
 
         past_active, past_recovered = self._calculate_recovered_and_active_until_now(df)
 
-        df['current_active_ratio'] = past_active[-1].fillna(0)
-        df['current_recovered_ratio'] = past_recovered[-1].fillna(0)
+        df['current_active_ratio'] = past_active.iloc[-1].fillna(0)
+        df['current_recovered_ratio'] = past_recovered.iloc[-1].fillna(0)
 
         df['transmission_rate'], df['transmission_rate_std'] = Model.growth_to_transmission_rate(
             growth=df['growth_rate'],
@@ -637,7 +2096,16 @@ class CovidData:
 
         return df, past_active, past_recovered
 
-    def table_with_projections(self, projection_days=(7, 14, 30), debug_dfs=False):
+    def table_with_projections(self, projection_days=(7, 14, 30), debug_dfs=False,
+                               n_perturbations=10, quantiles=(),
+                               debug_countries=None, debug_day_window=None):
+        """
+        :param debug_dfs: whether to also return the long format model timeseries
+            dataframe (see Model.timeseries_for_countries)
+        :param debug_countries: countries to include in the timeseries, default all
+        :param debug_day_window: (first, last) days relative to today to include in
+            the timeseries, default all
+        """
 
         df, past_active, past_recovered = self.table_with_current_rates_and_ratios()
 
@@ -645,42 +2113,124 @@ class CovidData:
             df,
             past_active=past_active.copy(),
             past_recovered=past_recovered.copy(),
-            projection_days=projection_days)
+            projection_days=projection_days,
+            n_perturbations=n_perturbations,
+            quantiles=quantiles)
 
         if debug_dfs:
             debug_dfs = Model.timeseries_for_countries(
-                debug_countries=df.index,
+                debug_countries=df.index if debug_countries is None else debug_countries,
                 traces=traces,
                 simulation_start_day=len(past_recovered) - 1,
-                infection_rate=df['transmission_rate'])
+                infection_rate=df['transmission_rate'],
+                day_window=debug_day_window)
             return df, debug_dfs
         return df
 
-    def _calculate_recovered_and_active_until_now(self, df):
+    def _calculate_recovered_and_active_until_now(
+            self, df) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        :return: active and recovered ratios of population (days x countries) dataframes
+        """
         # estimated daily cases ratios of population
-        lagged_cases_ratios = (self.cases_est_dft[self.dt_cols].T / df['population'].T).T
+        population = df['population'].reindex(self.cases_est.index).values
+        lagged_cases_ratios = self.cases_est.values / population[:, None]
         # protect from testing bias over-inflation
         lagged_cases_ratios[lagged_cases_ratios > 1] = 1
 
-        # run through history and estimate recovered and active using:
-        # https://covid19dashboards.com/outstanding_cases/#Appendix:-Methodology-of-Predicting-Recovered-Cases
-        actives, recs = [], []
-        zeros_series = lagged_cases_ratios[self.dt_cols[0]] * 0  # this is to have consistent types
-        for day in range(len(self.dt_cols)):
-            # previous day
-            prev_rec = recs[day - 1] if day > 0 else zeros_series
-            # lagged recoveries
-            tot_lagged_9 = lagged_cases_ratios[self.dt_cols[day - 9]] if day >= 9 else zeros_series
-            new_recs = prev_rec + (tot_lagged_9 - prev_rec) * Model.recovery_lagged9_rate
-            # clip recoveries by current cases
-            cur_cases = lagged_cases_ratios[self.dt_cols[day]]
-            new_recs[new_recs > cur_cases] = cur_cases[new_recs > cur_cases]
-            new_actives = cur_cases - new_recs
-            # assign
-            recs.append(new_recs)
-            actives.append(new_actives)
-
-        return actives, recs
+        # run through history and estimate recovered, only the new days for regions
+        # whose previous days didn't change
+        checkpoint = Checkpoint(
+            f'{type(self).__name__}.recovered',
+            params={'rate': Model.recovery_lagged9_rate,
+                    'code': Checkpoint.code_hash(recovery_recurrence)},
+            index=self.cases_est.index, columns=self.dt_cols,
+            inputs={'cases': lagged_cases_ratios})
+        recs = np.empty(lagged_cases_ratios.shape)
+        checkpoint.restore(recs=recs)
+        for rows, start in checkpoint.groups():
+            recs[rows] = recovery_recurrence(
+                lagged_cases_ratios[rows], Model.recovery_lagged9_rate, recs[rows, :start])
+        checkpoint.save(recs=recs)
+
+        cases = lagged_cases_ratios.T
+        recs = recs.T
+        actives = cases - recs
+
+        def to_df(arr):
+            return self._stored(
+                pd.DataFrame(arr, index=self.dt_cols, columns=self.cases_est.index))
+
+        return to_df(actives), to_df(recs)
+
+
+class RegionalCovidData(CovidData):
+    """
+    CovidData of subnational regions: the provinces / states of the JHU global data
+    (countries without them are a single region), and optionally the US counties from
+    local copies of JHU's US time series (instead of the US total).
+
+    Region labels are like JHU's "Combined_Key", e.g. "New South Wales, Australia" and
+    "Kings, New York, US". Regions use their countries' data from the other sources
+    (e.g. age adjusted IFR, ICU capacity) except for population, which is per region
+    from JHU's lookup table (or the US deaths file).
+
+    Source data is loaded and cached separately from CovidData, so to use the US
+    counties set `us_counties_folder` before first use (or call reload() after).
+    """
+    # folder of local time_series_covid19_{confirmed,deaths}_US.csv files, None for
+    # the US as a single region
+    us_counties_folder: str = None
+
+    @classmethod
+    def source_dataframe(cls, name) -> pd.DataFrame:
+        df = SourceData.get_covid_dataframe(name)
+        if not cls.us_counties_folder:
+            return df
+
+        dates = SourceData.get_dates(df)
+        df_us = SourceData.read_us_counties(name, cls.us_counties_folder)
+        # the local files can be older or newer than the global data
+        us_values = df_us.reindex(columns=dates).ffill(axis=1).fillna(0).astype(int)
+        df_us = pd.concat([df_us[['Admin2'] + SourceData.meta_cols], us_values], axis=1)
+        return pd.concat([df[df[COL_REGION] != 'US'], df_us], ignore_index=True)
+
+    @classmethod
+    def region_labels(cls, df: pd.DataFrame) -> pd.Series:
+        labels = df[COL_REGION]
+        for col in ['Province/State', 'Admin2']:
+            if col in df:
+                labels = (df[col] + ', ' + labels).fillna(labels)
+        return labels.rename(COL_REGION)
+
+    @classmethod
+    @func_cache
+    def regions_population(cls) -> pd.Series:
+        """Population of the regions from JHU's lookup table and the US deaths file"""
+        population = pd.Series(dtype=float)
+        try:
+            df_lookup = SourceData.regions_lookup()
+            population = df_lookup.groupby(cls.region_labels(df_lookup))['Population'].first()
+        except Exception as e:
+            warnings.warn(f'Failed loading regions population: {e!r}')
+        if cls.us_counties_folder:
+            df_us = SourceData.read_us_counties('deaths', cls.us_counties_folder)
+            population = population.combine_first(
+                df_us.groupby(cls.region_labels(df_us))['Population'].first())
+        return population.where(population > 0)
+
+    @classmethod
+    def reload(cls):
+        super().reload()
+        cls.regions_population.cache_clear()
+
+    def _extra_data_for(self, regions: pd.Index) -> pd.DataFrame:
+        extra = super()._extra_data_for(regions)
+        # regions that are whole countries can fall back to the countries' population
+        is_country = (self.region_countries.reindex(regions) == regions).to_numpy()
+        extra['population'] = (self.regions_population().reindex(regions)
+                               .fillna(extra['population'].where(is_country)).to_numpy())
+        return extra
 
 
 class Model:
@@ -690,41 +2240,59 @@ class Model:
     rec_rate_simple = 0.05
 
     @classmethod
+    def __disk_cache_key__(cls):
+        return cls.__name__, cls.recovery_lagged9_rate, cls.rec_rate_simple
+
+    @classmethod
+    @DiskCache.memoize
     def run_model_forward(cls,
                           df,
                           past_active,
                           past_recovered,
                           projection_days,
+                          n_perturbations=10,
+                          quantiles=(),
                           ):
+        """
+        Projects the SIR model for the center growth rates and an ensemble of growth rates
+        perturbed by up to one standard deviation, simulated together in one batch.
 
-        sus, act, rec = cls._run_sir_model(
-            past_recovered, past_active, df['growth_rate'], n_days=projection_days[-1])
-
-        # sample more growth rates
-        sus_lists = [[s] for s in sus]
-        act_lists = [[a] for a in act]
-        rec_lists = [[r] for r in rec]
-
-        for ratio in np.linspace(-1, 1, 10):
-            pert_growth = df['growth_rate'] + ratio * df['growth_rate_std']
-            pert_growth[pert_growth < 0] = 0
-            sus_other, act_other, rec_other = cls._run_sir_model(
-                past_recovered, past_active, pert_growth, n_days=projection_days[-1])
-            for s_list, s in zip(sus_lists, sus_other):
-                s_list.append(s)
-            for a_list, a in zip(act_lists, act_other):
-                a_list.append(a)
-            for r_list, r in zip(rec_lists, rec_other):
-                r_list.append(r)
-
-        def list_to_max_min(l):
-            concated = [pd.concat(sub_l, axis=1) for sub_l in l]
-            max_list, min_list = zip(*[(d.max(1), d.min(1)) for d in concated])
-            return max_list, min_list
-
-        sus_max, sus_min = list_to_max_min(sus_lists)
-        act_max, act_min = list_to_max_min(act_lists)
-        rec_max, rec_min = list_to_max_min(rec_lists)
+        :param n_perturbations: number of perturbed ensemble members
+        :param quantiles: ensemble quantiles to add (as ".q{quantile}" columns and
+            "{trace}_q{quantile}" traces) in addition to the max and min bands
+        :return: df with projection columns, dict of (days x countries) traces
+        """
+        countries = past_active.columns
+        growth = df['growth_rate'].reindex(countries).values
+        growth_std = df['growth_rate_std'].reindex(countries).values
+
+        # sample more growth rates, the center is the first member
+        pert_growth = growth + np.linspace(-1, 1, n_perturbations)[:, None] * growth_std
+        pert_growth[pert_growth < 0] = 0
+        members_growth = np.vstack([growth, pert_growth])
+
+        # (members x days x countries) of projected days only
+        members = dict(zip(['sus', 'act', 'rec'], cls._run_sir_model(
+            past_recovered, past_active, members_growth, n_days=projection_days[-1])))
+
+        def band_func(band):
+            if band == 'center':
+                return lambda m: m[0]
+            if band in ('max', 'min'):
+                return functools.partial(getattr(np, f'nan{band}'), axis=0)
+            return functools.partial(cls._nanquantile, q=float(band[1:]))
+
+        history = {'rec': past_recovered.values, 'act': past_active.values}
+        history['sus'] = 1 - history['rec'] - history['act']
+        bands = ['center', 'max', 'min'] + [f'q{q:g}' for q in quantiles]
+        traces = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # all nan countries
+            for name, arr in members.items():
+                for band in bands:
+                    traces[f'{name}_{band}'] = pd.DataFrame(
+                        np.concatenate([history[name], band_func(band)(arr)]),
+                        columns=countries)
 
         day_one = len(past_recovered)
         for day in [1] + list(projection_days):
@@ -732,25 +2300,46 @@ class Model:
             suffix = f'.+{day}d' if day > 1 else ''
 
             icu_max = df['age_adjusted_icu_percentage'] * 1e5
-
-            df[f'needICU.per100k{suffix}'] = act[ind] * icu_max
-            df[f'needICU.per100k{suffix}.max'] = act_max[ind] * icu_max
-            df[f'needICU.per100k{suffix}.min'] = act_min[ind] * icu_max
-            df[f'needICU.per100k{suffix}.err'] = (act_max[ind] - act_min[ind]) * icu_max / 2
-
-            df[f'affected_ratio.est{suffix}'] = 1 - sus[ind]
-            df[f'affected_ratio.est{suffix}.max'] = 1 - sus_min[ind]
-            df[f'affected_ratio.est{suffix}.min'] = 1 - sus_max[ind]
-            df[f'affected_ratio.est{suffix}.err'] = (sus_max[ind] - sus_min[ind]) / 2
-
-        traces = {
-            'sus_center': sus, 'sus_max': sus_max, 'sus_min': sus_min,
-            'act_center': act, 'act_max': act_max, 'act_min': act_min,
-            'rec_center': rec, 'rec_max': rec_max, 'rec_min': rec_min,
-        }
+            act = {band: traces[f'act_{band}'].iloc[ind] for band in bands}
+            sus = {band: traces[f'sus_{band}'].iloc[ind] for band in bands}
+
+            df[f'needICU.per100k{suffix}'] = act['center'] * icu_max
+            df[f'needICU.per100k{suffix}.max'] = act['max'] * icu_max
+            df[f'needICU.per100k{suffix}.min'] = act['min'] * icu_max
+            df[f'needICU.per100k{suffix}.err'] = (act['max'] - act['min']) * icu_max / 2
+
+            df[f'affected_ratio.est{suffix}'] = 1 - sus['center']
+            df[f'affected_ratio.est{suffix}.max'] = 1 - sus['min']
+            df[f'affected_ratio.est{suffix}.min'] = 1 - sus['max']
+            df[f'affected_ratio.est{suffix}.err'] = (sus['max'] - sus['min']) / 2
+
+            for q in quantiles:
+                # affected ratio is decreasing in susceptible, so its quantile q is
+                # computed from the members directly rather than from a sus band
+                affected_q = cls._nanquantile(1 - members['sus'][:, day - 1], q)
+                df[f'needICU.per100k{suffix}.q{q:g}'] = act[f'q{q:g}'] * icu_max
+                df[f'affected_ratio.est{suffix}.q{q:g}'] = pd.Series(affected_q, index=countries)
 
         return df, traces
 
+    @staticmethod
+    def _nanquantile(arr: np.ndarray, q: float) -> np.ndarray:
+        """
+        Linear interpolation quantile over the first axis ignoring nans, same as
+        np.nanquantile(arr, q, axis=0) but without its python loop over columns with nans
+        """
+        ordered = np.sort(arr, axis=0)  # nans are sorted last
+        n_valid = (~np.isnan(arr)).sum(axis=0)
+        last = np.maximum(n_valid - 1, 0)
+        pos = q * last
+        low = np.floor(pos).astype(int)
+        high = np.minimum(low + 1, last)
+        low_vals = np.take_along_axis(ordered, low[None], axis=0)[0]
+        high_vals = np.take_along_axis(ordered, high[None], axis=0)[0]
+        quantiles = low_vals + (high_vals - low_vals) * (pos - low)
+        quantiles[n_valid == 0] = np.nan
+        return quantiles
+
     @classmethod
     def growth_to_transmission_rate(cls, growth, rec, act, growth_std=None):
         daily_delta = growth
@@ -778,65 +2367,112 @@ class Model:
         return infect_rate, infect_std
 
     @classmethod
-    def _run_sir_model(cls, past_rec, past_act, growth, n_days):
-        rec, act = past_rec.copy(), past_act.copy()
+    def _run_sir_model(cls, past_rec: pd.DataFrame, past_act: pd.DataFrame,
+                       growth: np.ndarray, n_days: int
+                       ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param past_rec: recovered ratios history (days x countries)
+        :param past_act: active ratios history (days x countries)
+        :param growth: growth rates (countries), or (members x countries) to simulate
+            an ensemble in one batch, ordered as past_act's columns
+        :param n_days: number of days to simulate
+        :return: susceptible, active, recovered ratios (... x days x countries) arrays
+            of the simulated days (without the history)
+        """
+        infect_rate, _ = cls.growth_to_transmission_rate(
+            growth, past_rec.values[-1], past_act.values[-1])
+
+        # countries are the last axis of the inputs and results
+        rec, act = RowShards.map(cls._simulate_sir,
+                                 [past_rec.values, past_act.values, infect_rate],
+                                 axis=-1, n_days=n_days)
+        sus = 1 - rec - act
+        return sus, act, rec
 
-        infect_rate, _ = cls.growth_to_transmission_rate(growth, rec[-1], act[-1])
+    @classmethod
+    def _simulate_sir(cls, past_rec: np.ndarray, past_act: np.ndarray,
+                      infect_rate: np.ndarray, n_days: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param infect_rate: transmission rates (countries), or (members x countries)
+        :return: recovered and active (... x n_days x countries) arrays of the simulated days
+        """
+        lag = 9  # days lag of recovery_lagged9_rate, only this much history is needed
+        infect_rate = np.asarray(infect_rate, dtype=float)
+        # days are the first axis during the simulation to update contiguous rows
+        rec = np.empty((lag + n_days,) + infect_rate.shape)
+        act = np.empty_like(rec)
+        rec[:lag] = past_rec[-lag:].reshape((lag,) + (1,) * (infect_rate.ndim - 1) + (-1,))
+        act[:lag] = past_act[-lag:].reshape((lag,) + (1,) * (infect_rate.ndim - 1) + (-1,))
+        sus = np.empty(infect_rate.shape)
+        delta_rec = np.empty_like(sus)
+        delta_rec_simple = np.empty_like(sus)
 
         # simulate
-        for i in range(n_days):
+        for i in range(lag, lag + n_days):
             # calculate susceptible
-            sus = 1 - rec[-1] - act[-1]
+            np.subtract(1, rec[i - 1], out=sus)
+            sus -= act[i - 1]
 
             # calculate new recovered
-            actives_lagged_9 = act[-9]
-            delta_rec = actives_lagged_9 * cls.recovery_lagged9_rate
-            delta_rec_simple = act[-1] * cls.rec_rate_simple
+            np.multiply(act[i - lag], cls.recovery_lagged9_rate, out=delta_rec)
+            np.multiply(act[i - 1], cls.rec_rate_simple, out=delta_rec_simple)
             # limit recovery rate to simple SIR model where
             # lagged rate estimation becomes too high (on the downward slopes)
-            delta_rec[delta_rec > delta_rec_simple] = delta_rec_simple[delta_rec > delta_rec_simple]
-            new_recovered = rec[-1] + delta_rec
-
-            # calculate new active
-            delta_infect = act[-1] * sus * infect_rate
-            new_active = act[-1] + delta_infect - delta_rec
+            np.copyto(delta_rec, delta_rec_simple, where=delta_rec > delta_rec_simple)
+            np.add(rec[i - 1], delta_rec, out=rec[i])
+
+            # calculate new active (delta infect is act * sus * infect_rate)
+            new_active = act[i]
+            np.multiply(act[i - 1], sus, out=new_active)
+            new_active *= infect_rate
+            new_active += act[i - 1]
+            new_active -= delta_rec
             new_active[new_active < 0] = 0
 
-            # update
-            rec.append(new_recovered)
-            act.append(new_active)
-
-        sus = [1 - r - a for r, a in zip(rec, act)]
-
-        return sus, act, rec
+        return np.moveaxis(rec[lag:], 0, -2), np.moveaxis(act[lag:], 0, -2)
 
     @staticmethod
-    def timeseries_for_countries(debug_countries, traces,
-                                 simulation_start_day, infection_rate):
-        dfs = []
-        for debug_country in debug_countries:
-            debug = [{'day': day - simulation_start_day,
-                      'Susceptible': traces['sus_center'][day][debug_country],
-                      'Susceptible.max': traces['sus_max'][day][debug_country],
-                      'Susceptible.min': traces['sus_min'][day][debug_country],
-                      'Infected': traces['act_center'][day][debug_country],
-                      'Infected.max': traces['act_max'][day][debug_country],
-                      'Infected.min': traces['act_min'][day][debug_country],
-                      'Removed': traces['rec_center'][day][debug_country],
-                      'Removed.max': traces['rec_max'][day][debug_country],
-                      'Removed.min': traces['rec_min'][day][debug_country],
-                      }
-                     for day in range(len(traces['rec_center']))]
-
-            title = (f"{debug_country}: "
-                     f"Transmission Rate: {infection_rate[debug_country]:.1%}. "
-                     f"S/I/R init: {debug[0]['Susceptible']:.1%},"
-                     f"{debug[0]['Infected']:.1%},{debug[0]['Removed']:.1%}")
-            df = pd.DataFrame(debug).set_index('day')
-            df['title'] = title
-            df['country'] = debug_country
-            dfs.append(df)
-        return dfs
+    def timeseries_for_countries(debug_countries, traces, simulation_start_day,
+                                 infection_rate, day_window=None) -> pd.DataFrame:
+        """
+        :param debug_countries: countries to include
+        :param traces: dict of (days x countries) traces dataframes from run_model_forward
+        :param simulation_start_day: trace row of the last day of history (day 0)
+        :param infection_rate: transmission rates series for the titles
+        :param day_window: optional (first, last) inclusive days relative to simulation
+            start to include, either can be None for no limit
+        :return: long format dataframe with a row per country and day
+        """
+        countries = pd.Index(debug_countries)
+        col_inds = traces['rec_center'].columns.get_indexer(countries)
+        if (col_inds < 0).any():
+            raise KeyError(f'Countries not in traces: {list(countries[col_inds < 0])}')
+        days = np.arange(len(traces['rec_center'])) - simulation_start_day
+        first, last = day_window if day_window is not None else (None, None)
+        in_window = ((days >= first if first is not None else True) &
+                     (days <= last if last is not None else True))
+        row_inds = np.flatnonzero(np.broadcast_to(in_window, days.shape))
+
+        trace_cols = {'Susceptible': 'sus', 'Infected': 'act', 'Removed': 'rec'}
+        bands = {'': 'center', '.max': 'max', '.min': 'min'}
+        data = {'day': np.tile(days[row_inds], len(countries))}
+        for col, trace in trace_cols.items():
+            for suffix, band in bands.items():
+                values = traces[f'{trace}_{band}'].values
+                data[col + suffix] = values[np.ix_(row_inds, col_inds)].T.ravel()
+
+        def pct(values):
+            return pd.Series(np.char.mod('%.1f%%', np.asarray(values, dtype=float) * 100))
+
+        init = {col: traces[f'{trace}_center'].values[0, col_inds]
+                for col, trace in trace_cols.items()}
+        titles = (pd.Series(countries) + ': ' +
+                  'Transmission Rate: ' + pct(infection_rate.reindex(countries)) + '. ' +
+                  'S/I/R init: ' + pct(init['Susceptible']) + ',' +
+                  pct(init['Infected']) + ',' + pct(init['Removed']))
+        data['title'] = np.repeat(titles.values, len(row_inds))
+        data['country'] = np.repeat(countries.values, len(row_inds))
+        return pd.DataFrame(data)
 
 
 def altair_sir_plot(df_alt, default_country):
@@ -982,21 +2618,21 @@ class GeoMap:
         world = geopandas.read_file(shapefile)[['ADMIN', 'ADM0_A3', 'geometry']]
         world.columns = ['country', 'iso_code', 'geometry']
         world = world[world['country'] != "Antarctica"].copy()
-        world['country'] = world['country'].map({
-            'United States of America': 'US',
-            'Taiwan': 'Taiwan*',
-            'Palestine': 'West Bank and Gaza',
-            'Côte d\'Ivoire': 'Cote d\'Ivoire',
-            'Bosnia and Herz.': 'Bosnia and Herzegovina',
-        }).fillna(world['country'])
+        world['country'] = Countries.canonical(world['country'])
         return world
 
     @classmethod
     def make_geo_df(cls, df_all, cases_filter=1000, deaths_filter=20):
+        """
+        :param df_all: table indexed by (canonical) country names, other regions
+            (e.g. provinces of RegionalCovidData tables) don't have shapes and are dropped
+        """
         world = cls.get_world_geo_df()
 
-        df_plot = (df_all.reset_index().rename(columns={COL_REGION: 'country'}))
-        df_plot_geo = pd.merge(world, df_plot, on='country', how='left')
+        # positional left join on the countries' codes
+        countries = Countries(df_all.index)
+        df_plot_geo = world.reset_index(drop=True).join(
+            countries.take(countries.align(df_all), countries.codes(world['country'])))
 
         df_plot_geo = df_plot_geo[((df_plot_geo['Cases.total'] >= cases_filter)
                                    | (df_plot_geo['Deaths.total'] >= deaths_filter))]
@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from covid_helpers import (Checkpoint, HttpCache, Model, ScrapedTableBase, SourceData,
+                           backfill_missing, backfill_missing_matrix, backfill_missing_resume)
+
+
+@pytest.fixture
+def jhu_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(SourceData, '_cache_path',
+                        classmethod(lambda cls, name: str(tmp_path / name)))
+    return tmp_path
+
+
+def jhu_df(n_rows=30, n_dates=20, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = [f'{1 + i // 28}/{1 + i % 28}/20' for i in range(n_dates)]
+    values = np.cumsum(rng.integers(0, 100, (n_rows, n_dates)), axis=1)
+    df = pd.DataFrame({'Province/State': [f'P{i}' if i % 3 else None for i in range(n_rows)],
+                       'Country/Region': [f'C{i}' for i in range(n_rows)],
+                       'Lat': rng.random(n_rows),
+                       'Long': rng.random(n_rows)})
+    return pd.concat([df, pd.DataFrame(values, columns=dates)], axis=1)
+
+
+def ingest(df, crlf=False):
+    content = df.to_csv(index=False).encode()
+    if crlf:
+        content = content.replace(b'\n', b'\r\n')
+    return SourceData._ingest_covid_df('confirmed', content)
+
+
+def assert_ingested(df, expected):
+    pd.testing.assert_frame_equal(df.reset_index(drop=True), expected, check_dtype=False)
+    values, meta_df, dates = SourceData.load_covid_matrix('confirmed')
+    np.testing.assert_array_equal(values, expected[dates].to_numpy())
+
+
+@pytest.fixture
+def delta_calls(monkeypatch):
+    """whether each _ingest_delta call was incremental"""
+    calls = []
+    ingest_delta = SourceData._ingest_delta.__func__
+
+    def spy(cls, *args):
+        df = ingest_delta(cls, *args)
+        calls.append(df is not None)
+        return df
+
+    monkeypatch.setattr(SourceData, '_ingest_delta', classmethod(spy))
+    return calls
+
+
+def test_ingest_appended_dates(jhu_folder, delta_calls):
+    full = jhu_df()
+    assert_ingested(ingest(full.iloc[:, :-5]), full.iloc[:, :-5])
+    assert_ingested(ingest(full), full)
+    assert delta_calls == [False, True]
+
+
+def test_ingest_appended_and_revised(jhu_folder, delta_calls):
+    full = jhu_df()
+    ingest(full.iloc[:, :-2])
+    revised = full.copy()
+    revised.iloc[3, 6] += 5
+    revised.loc[5, 'Lat'] = 1.5
+    assert_ingested(ingest(revised), revised)
+    assert delta_calls == [False, True]
+
+
+@pytest.mark.parametrize('crlf', [False, True])
+def test_ingest_revision_only(jhu_folder, delta_calls, crlf):
+    full = jhu_df()
+    ingest(full)
+    revised = full.copy()
+    revised.iloc[7, 10] += 3
+    assert_ingested(ingest(revised, crlf=crlf), revised)
+    assert delta_calls == [False, True]
+
+
+def test_ingest_wide_revision_is_full_rebuild(jhu_folder, delta_calls):
+    full = jhu_df()
+    ingest(full)
+    revised = full.copy()
+    revised.iloc[:20, 8] += 1
+    assert_ingested(ingest(revised), revised)
+    assert delta_calls == [False, False]
+
+
+@pytest.fixture
+def slow_server():
+    """local server that streams its content slowly, so that fetches overlap"""
+    content = b'x' * 100_000
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            for i in range(0, len(content), 10_000):
+                self.wfile.write(content[i:i + 10_000])
+                time.sleep(0.01)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/data.csv', content
+    server.shutdown()
+
+
+def test_concurrent_fetches_of_same_url(slow_server, tmp_path, monkeypatch):
+    url, content = slow_server
+    monkeypatch.setattr(HttpCache, 'cache_folder', str(tmp_path))
+    monkeypatch.setattr(HttpCache, 'offline', False)
+    monkeypatch.setattr(HttpCache, 'mirror', None)
+    with ThreadPoolExecutor(4) as executor:
+        paths = list(executor.map(lambda _: HttpCache.fetch_path(url), range(4)))
+    assert len(set(paths)) == 1
+    with open(paths[0], 'rb') as f:
+        assert f.read() == content
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+@pytest.fixture
+def scraped_table(tmp_path, monkeypatch):
+    scrapes = []
+
+    class Table(ScrapedTableBase):
+        file_name = 'table.csv'
+        refresh_in_background = False
+
+        @classmethod
+        def scrape(cls):
+            scrapes.append(time.time())
+            return pd.DataFrame({'country': ['A', 'B'], 'value': [len(scrapes)] * 2})
+
+    monkeypatch.setattr(Table, 'csv_path', classmethod(lambda cls: str(tmp_path / cls.file_name)))
+    Table.scrapes = scrapes
+    return Table
+
+
+def test_scraped_table_staleness_is_kept_in_the_data(scraped_table):
+    scraped_table.load()
+    assert len(scraped_table.scrapes) == 1 and not scraped_table.is_stale()
+
+    # a fresh file modification time (e.g. a git checkout) doesn't make an old scrape fresh
+    with open(scraped_table._scrape_info_path(), 'w') as f:
+        json.dump({'scraped_at': time.time() - scraped_table.ttl - 1}, f)
+    os.utime(scraped_table.csv_path())
+    assert scraped_table.is_stale()
+    assert (scraped_table.load()['value'] == 2).all()
+    assert not scraped_table.is_stale()
+
+    # a table without the scrape time (e.g. saved by an older version) is stale
+    os.remove(scraped_table._scrape_info_path())
+    assert scraped_table.is_stale()
+
+
+def test_scraped_table_refreshes_in_foreground_in_ci(scraped_table, monkeypatch):
+    scraped_table.refresh_in_background = None
+    monkeypatch.setenv('CI', 'true')
+    assert not scraped_table._background_refresh()
+    monkeypatch.delenv('CI')
+    assert scraped_table._background_refresh()
+
+
+def random_diffs(seed, shape=(40, 80), threshold=50):
+    """daily cases with zeros, negatives, NaNs, and values around the threshold"""
+    rng = np.random.default_rng(seed)
+    choices = [0, 0, 0, threshold - 1, threshold, threshold + 1, 200, 7, -3, np.nan]
+    return rng.choice(choices, size=shape).astype(float)
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('threshold', [50, 0])
+def test_backfill_matrix_equals_per_series(seed, threshold):
+    diffs = random_diffs(seed, threshold=threshold)
+    expected = np.vstack([backfill_missing(pd.Series(row), threshold).to_numpy(dtype=float)
+                          for row in diffs])
+    result = backfill_missing_matrix(diffs, threshold)
+    # bit for bit, including nans
+    assert result.dtype == expected.dtype
+    assert np.array_equal(result, expected, equal_nan=True)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_backfill_resumed_equals_matrix(seed):
+    diffs = random_diffs(seed)
+    expected = backfill_missing_matrix(diffs)
+    n_rows = len(diffs)
+    start = np.random.default_rng(seed).integers(1, diffs.shape[1])
+    first, _, prev, missing = backfill_missing_resume(
+        diffs[:, :start], prev=np.full(n_rows, -np.inf), missing=np.zeros(n_rows, dtype=np.int64))
+    rest, carried, _, _ = backfill_missing_resume(diffs[:, start:], prev, missing)
+    # the previous days' trailing missing runs get the value carried from the new days
+    run_rows, run_days = np.nonzero(np.arange(start) >= start - missing[:, None])
+    first[run_rows, run_days] = carried[run_rows]
+    assert np.array_equal(np.hstack([first, rest]), expected, equal_nan=True)
+
+
+def test_checkpoint_code_hash_covers_defaults(monkeypatch):
+    before = Checkpoint.code_hash(backfill_missing_resume)
+    monkeypatch.setattr(backfill_missing_resume, '__defaults__', (10,))
+    assert Checkpoint.code_hash(backfill_missing_resume) != before
+
+
+def test_timeseries_for_countries_unknown_country():
+    days = pd.RangeIndex(3)
+    traces = {f'{trace}_{band}': pd.DataFrame({'A': [0.1, 0.2, 0.3], 'Z': [0.4, 0.5, 0.6]},
+                                              index=days)
+              for trace in ['sus', 'act', 'rec'] for band in ['center', 'max', 'min']}
+    rates = pd.Series({'A': 0.1, 'Z': 0.2})
+    df = Model.timeseries_for_countries(['A'], traces, 1, rates)
+    assert (df['country'] == 'A').all() and df['Infected'].tolist() == [0.1, 0.2, 0.3]
+    with pytest.raises(KeyError, match='Atlantis'):
+        Model.timeseries_for_countries(['Atlantis'], traces, 1, rates)